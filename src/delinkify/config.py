@@ -1,10 +1,12 @@
 import inspect
 import logging
 import os
+import secrets
 import sys
-from dataclasses import dataclass, fields
+from dataclasses import dataclass, fields, replace
 from datetime import datetime
 from pathlib import Path
+from typing import Any
 
 from dotenv import load_dotenv
 from loguru import logger
@@ -17,6 +19,20 @@ def must_str(env_var: str) -> str:
     return value
 
 
+def bool_or_default(env_var: str, default: bool) -> bool:
+    value = os.environ.get(env_var)
+    if value is None:
+        return default
+    return value.strip().lower() in {'1', 'true', 'yes', 'on'}
+
+
+def choice_or_default(env_var: str, default: str, choices: set[str]) -> str:
+    value = os.environ.get(env_var, default)
+    if value not in choices:
+        raise ValueError(f'invalid value for {env_var}: {value}, expected one of {", ".join(sorted(choices))}')
+    return value
+
+
 def path_or_default(env_var: str, default: str) -> Path:
     root_path = Path(__file__).parent.parent.parent
     value = os.environ.get(env_var)
@@ -25,6 +41,28 @@ def path_or_default(env_var: str, default: str) -> Path:
     return Path(value).absolute()
 
 
+def download_engines_from_env(prefix: str, default: DownloadEngine) -> dict[str, DownloadEngine]:
+    """Per handler engines from `{prefix}{HANDLER}="fragments=8,chunk_mb=10"`, unset fields keep `default`."""
+    engines = {}
+    for env_var, value in os.environ.items():
+        if not env_var.startswith(prefix) or not value.strip():
+            continue
+        options: dict[str, Any] = {}
+        for option in value.split(','):
+            name, _, raw = option.partition('=')
+            name = name.strip()
+            if name == 'parallel_streams':
+                options[name] = raw.strip().lower() in {'1', 'true', 'yes', 'on'}
+            elif name in {'fragments', 'chunk_mb'}:
+                options[name] = int(raw)
+            else:
+                raise ValueError(
+                    f'invalid option for {env_var}: {name}, expected fragments, chunk_mb or parallel_streams'
+                )
+        engines[env_var.removeprefix(prefix).lower()] = replace(default, **options)
+    return engines
+
+
 def prepare_path(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
 
@@ -47,6 +85,15 @@ class InterceptHandler(logging.Handler):
         logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
 
 
+@dataclass(frozen=True)
+class DownloadEngine:
+    """How yt-dlp handlers download: fragments at once, http range size and merged streams in parallel."""
+
+    fragments: int = 4
+    chunk_mb: int = 0  # 0 downloads plain http formats in a single request
+    parallel_streams: bool = True
+
+
 @dataclass
 class Config:
     bot_token: str
@@ -55,9 +102,44 @@ class Config:
     log_level: str
     log_path: Path
     cache_save_interval: int
+    cache_backend: str
+    cache_max_entries: int
+    cache_ttl: int
+    negative_cache_max_ttl: int
     cache_path: Path
     media_path: Path
+    media_grace_period: int
+    media_max_mb: int
+    gc_interval: int
     cookie_path: Path
+    metadata_first: bool
+    resolve_short_links: bool
+    short_link_ttl: int
+    inline_deadline: float
+    hedge: bool
+    hedge_delay: float
+    executor_kind: str
+    executor_workers: int
+    executor_handler_limit: int
+    download_engine: DownloadEngine
+    download_engines: dict[str, DownloadEngine]  # by lowercase handler name
+    transcode_workers: int
+    transcode_threads: int
+    streaming: str
+    album_uploads: bool
+    prefetch: bool
+    prefetch_workers: int
+    prefetch_items: int
+    prefetch_kbps: int
+    transport: str
+    concurrent_updates: int
+    webhook_url: str
+    webhook_listen: str
+    webhook_port: int
+    webhook_secret: str
+    webhook_record_path: Path | None
+    metrics_listen: str
+    metrics_port: int
 
     @classmethod
     def from_env(cls) -> Config:
@@ -80,6 +162,12 @@ class Config:
         )
         logging.basicConfig(handlers=[InterceptHandler()], level=logging.WARNING, force=True)
 
+        download_engine = DownloadEngine(
+            fragments=int(os.environ.get('DELINKIFY_DOWNLOAD_FRAGMENTS', '4')),
+            chunk_mb=int(os.environ.get('DELINKIFY_DOWNLOAD_CHUNK_MB', '0')),
+            parallel_streams=bool_or_default('DELINKIFY_DOWNLOAD_PARALLEL_STREAMS', True),
+        )
+
         self = cls(
             bot_token=must_str('DELINKIFY_BOT_TOKEN'),
             dump_chat_id=must_str('DELINKIFY_DUMP_CHAT_ID'),
@@ -87,10 +175,48 @@ class Config:
             log_level=log_level,
             log_path=log_path,
             cache_save_interval=int(os.environ.get('DELINKIFY_CACHE_SAVE_INTERVAL', '300')),
+            cache_backend=os.environ.get('DELINKIFY_CACHE_BACKEND', 'sqlite'),
+            cache_max_entries=int(os.environ.get('DELINKIFY_CACHE_MAX_ENTRIES', '1000')),
+            cache_ttl=int(os.environ.get('DELINKIFY_CACHE_TTL', str(60 * 60 * 24 * 30))),
+            negative_cache_max_ttl=int(os.environ.get('DELINKIFY_NEGATIVE_CACHE_MAX_TTL', str(60 * 60 * 24 * 7))),
             cache_path=path_or_default('DELINKIFY_CACHE_PATH', 'cache'),
             media_path=path_or_default('DELINKIFY_MEDIA_PATH', 'media'),
+            media_grace_period=int(os.environ.get('DELINKIFY_MEDIA_GRACE_PERIOD', '3600')),
+            media_max_mb=int(os.environ.get('DELINKIFY_MEDIA_MAX_MB', '5120')),
+            gc_interval=int(os.environ.get('DELINKIFY_GC_INTERVAL', '600')),
             cookie_path=path_or_default('DELINKIFY_COOKIE_PATH', 'cookies'),
+            metadata_first=bool_or_default('DELINKIFY_METADATA_FIRST', True),
+            resolve_short_links=bool_or_default('DELINKIFY_RESOLVE_SHORT_LINKS', True),
+            short_link_ttl=int(os.environ.get('DELINKIFY_SHORT_LINK_TTL', str(60 * 60 * 24 * 7))),
+            inline_deadline=float(os.environ.get('DELINKIFY_INLINE_DEADLINE', '8')),
+            hedge=bool_or_default('DELINKIFY_HEDGE', False),
+            hedge_delay=float(os.environ.get('DELINKIFY_HEDGE_DELAY', '4')),
+            executor_kind=choice_or_default('DELINKIFY_EXECUTOR_KIND', 'thread', {'thread', 'process'}),
+            executor_workers=int(os.environ.get('DELINKIFY_EXECUTOR_WORKERS', '4')),
+            executor_handler_limit=int(os.environ.get('DELINKIFY_EXECUTOR_HANDLER_LIMIT', '2')),
+            download_engine=download_engine,
+            download_engines=download_engines_from_env('DELINKIFY_DOWNLOAD_ENGINE_', download_engine),
+            transcode_workers=int(os.environ.get('DELINKIFY_TRANSCODE_WORKERS', '2')),
+            transcode_threads=int(os.environ.get('DELINKIFY_TRANSCODE_THREADS', '2')),
+            streaming=choice_or_default('DELINKIFY_STREAMING', 'off', {'off', 'direct', 'pipe'}),
+            album_uploads=bool_or_default('DELINKIFY_ALBUM_UPLOADS', True),
+            prefetch=bool_or_default('DELINKIFY_PREFETCH', False),
+            prefetch_workers=int(os.environ.get('DELINKIFY_PREFETCH_WORKERS', '1')),
+            prefetch_items=int(os.environ.get('DELINKIFY_PREFETCH_ITEMS', '3')),
+            prefetch_kbps=int(os.environ.get('DELINKIFY_PREFETCH_KBPS', '0')),
+            transport=choice_or_default('DELINKIFY_TRANSPORT', 'polling', {'polling', 'webhook'}),
+            concurrent_updates=int(os.environ.get('DELINKIFY_CONCURRENT_UPDATES', '8')),
+            webhook_url=os.environ.get('DELINKIFY_WEBHOOK_URL', ''),
+            webhook_listen=os.environ.get('DELINKIFY_WEBHOOK_LISTEN', ''),  # empty listens on every interface
+            webhook_port=int(os.environ.get('DELINKIFY_WEBHOOK_PORT', '8080')),
+            # a fresh secret is registered with telegram on every start unless one is given
+            webhook_secret=os.environ.get('DELINKIFY_WEBHOOK_SECRET') or secrets.token_urlsafe(32),
+            webhook_record_path=Path(p) if (p := os.environ.get('DELINKIFY_WEBHOOK_RECORD_PATH')) else None,
+            metrics_listen=os.environ.get('DELINKIFY_METRICS_LISTEN', '127.0.0.1'),
+            metrics_port=int(os.environ.get('DELINKIFY_METRICS_PORT', '9464')),  # 0 disables the endpoint
         )
+        if self.transport == 'webhook' and not self.webhook_url:
+            raise ValueError('DELINKIFY_WEBHOOK_URL is required when DELINKIFY_TRANSPORT is webhook')
 
         prepare_path(self.log_path)
         prepare_path(self.cache_path)
@@ -98,7 +224,10 @@ class Config:
         prepare_path(self.cookie_path)
 
         logger.info('config parsed successfully')
-        for f in [fi for fi in fields(self) if fi.name not in ['bot_token', 'extra']]:
+        for f in [fi for fi in fields(self) if fi.name not in ['bot_token', 'webhook_secret', 'extra']]:
             logger.info(f'{f.name:<{20}}: {getattr(self, f.name)}')
 
         return self
+
+    def engine_for(self, handler: str) -> DownloadEngine:
+        return self.download_engines.get(handler.lower(), self.download_engine)
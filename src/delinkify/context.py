@@ -5,7 +5,16 @@ from delinkify.config import Config
 from delinkify.handler.router import Router
 
 if TYPE_CHECKING:
+    from delinkify.media.media import Media, MediaCollection
     from delinkify.util.cache import Cache
+    from delinkify.util.executor import DownloadExecutor
+    from delinkify.util.jobs import JobQueue
+    from delinkify.util.latency import LatencyTracker
+    from delinkify.util.negative_cache import NegativeCache
+    from delinkify.util.prefetcher import Prefetcher
+    from delinkify.util.short_links import ShortLinkResolver
+    from delinkify.util.singleflight import SingleFlight
+    from delinkify.util.transcoder import Transcoder
 
 
 class DelinkifyContext(CallbackContext[ExtBot, dict, dict, dict]):
@@ -19,3 +28,14 @@ class DelinkifyContext(CallbackContext[ExtBot, dict, dict, dict]):
         self.config: Config = application.bot_data['config']
         self.router: Router = application.bot_data['router']
         self.cache: Cache = application.bot_data['cache']
+        self.failures: NegativeCache = application.bot_data['failures']
+        self.latencies: LatencyTracker = application.bot_data['latencies']
+        self.jobs: JobQueue = application.bot_data['jobs']
+        self.executor: DownloadExecutor = application.bot_data['executor']
+        self.transcoder: Transcoder = application.bot_data['transcoder']
+        self.prefetcher: Prefetcher | None = application.bot_data['prefetcher']
+        self.short_links: ShortLinkResolver | None = application.bot_data['short_links']
+        self.resolving: SingleFlight[MediaCollection | None] = application.bot_data['resolving']
+        self.materializing: SingleFlight[Media] = application.bot_data['materializing']
+        self.downloading: SingleFlight[None] = application.bot_data['downloading']
+        self.uploading: SingleFlight[None] = application.bot_data['uploading']
@@ -0,0 +1,67 @@
+import json
+from typing import Any
+
+from delinkify.context import DelinkifyContext
+from delinkify.handler.handler import Handler, HandlerError
+from delinkify.media import Media, MediaCollection
+from delinkify.util import gdl_probe, gdl_run, get_cookie_file_path
+
+
+class GalleryDLHandler(Handler):
+    """Base for handlers that fetch posts with any number of files through gallery-dl."""
+
+    category: str  # gallery-dl extractor category
+    filename = '{id}_{num:>02}.{extension}'
+    cookie_name: str | None = None
+    caption_fields = ['description', 'title', 'content']
+
+    def caption(self, meta: dict[str, Any]) -> str | None:
+        return next((meta[f] for f in self.caption_fields if meta.get(f)), None)
+
+    def thumbnail(self, file_url: str, meta: dict[str, Any]) -> str | None:
+        candidates = [meta.get('thumbnail')]
+        if meta.get('extension') in {'jpg', 'jpeg', 'png', 'webp'}:
+            candidates.append(file_url)
+        return next((c for c in candidates if isinstance(c, str) and c.startswith('https://')), None)
+
+    def job_args(self, mc: MediaCollection, context: DelinkifyContext) -> tuple:
+        cookie_file_path = get_cookie_file_path(self.cookie_name, context) if self.cookie_name else None
+        return self.name, mc.url, mc.get_media_path(context), self.category, self.filename, cookie_file_path
+
+    async def handle(self, url: str, context: DelinkifyContext) -> MediaCollection:
+        mc = MediaCollection(url=url, handler=self.name)
+        media_path = mc.get_media_path(context)
+        await context.executor.run(self.name, gdl_run, *self.job_args(mc, context))
+
+        caption = None
+        meta_file = media_path / 'metadata.json'
+        if meta_file.exists():
+            caption = self.caption(json.loads(meta_file.read_text()))
+
+        for f in sorted(media_path.rglob('*')):
+            if f.is_file() and f.suffix != '.json':
+                mc.add_media(Media(source=f, caption=caption or f.name), context)
+
+        return mc
+
+    async def probe(self, url: str, context: DelinkifyContext) -> MediaCollection | None:
+        mc = MediaCollection(url=url, handler=self.name)
+        files = await context.executor.run(self.name, gdl_probe, *self.job_args(mc, context))
+        if not files:
+            return None  # let `handle` download whatever there is
+        for source, file_url, meta in files:
+            mc.add_media(
+                Media(
+                    source=source,
+                    caption=self.caption(meta) or source.name,
+                    thumbnail_url=self.thumbnail(file_url, meta),
+                ),
+                context,
+            )
+        return mc
+
+    async def download(self, mc: MediaCollection, context: DelinkifyContext) -> None:
+        await context.executor.run(self.name, gdl_run, *self.job_args(mc, context))
+        missing = [m.source.name for m in mc.media.values() if not m.is_materialized and not m.is_downloaded]
+        if missing:
+            raise HandlerError(f'handler {self.name} did not download {missing}')
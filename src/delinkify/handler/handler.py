@@ -1,23 +1,72 @@
+import asyncio
+import functools
+import re
+import shutil
+import time
 import traceback
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING
+from collections.abc import Callable, Coroutine
+from functools import cached_property
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
 from loguru import logger
 from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
 from telegram.error import NetworkError
 
+from delinkify.util.content import total_size
+from delinkify.util.jobs import Job, JobState
+from delinkify.util.metrics import downloaded_bytes, stage_seconds
+from delinkify.util.negative_cache import FailureClass, classify
+from delinkify.util.transcoder import Priority
+from delinkify.util.url import canonicalize, media_dir_for
+
 if TYPE_CHECKING:
     from delinkify.context import DelinkifyContext
-    from delinkify.media.media import MediaCollection
+    from delinkify.media.media import Media, MediaCollection
+    from delinkify.util.singleflight import SingleFlight
 
 
 class Handler(ABC):
     url_patterns: list[str]
+    domains: list[str] = []  # registrable domains the router indexes this handler under, empty means any
     weight: int = 0
+    platform: str | None = None  # handlers of the same platform share cache keys
 
     @abstractmethod
     async def handle(self, url: str, context: DelinkifyContext) -> MediaCollection: ...
 
+    async def probe(self, url: str, context: DelinkifyContext) -> MediaCollection | None:
+        """Resolve the metadata of `url` without downloading, the media files do not exist yet.
+
+        Handlers that cannot do this return None and are resolved through `handle` instead.
+        """
+        return None
+
+    @abstractmethod
+    async def download(self, mc: MediaCollection, context: DelinkifyContext) -> None:
+        """Download the files of a collection previously returned by `probe`."""
+
+    @cached_property
+    def patterns(self) -> list[re.Pattern]:
+        return [re.compile(p) for p in self.url_patterns]
+
+    def matches(self, url: str) -> bool:
+        return any(p.match(url) for p in self.patterns)
+
+    def canonical_key(self, url: str) -> str | None:
+        """Cache key for `url`, built from the platform and the `id` group of the matching pattern.
+
+        Returns None when the handler cannot tell, the canonical url is used as key then.
+        """
+        if self.platform is None:
+            return None
+        for p in self.patterns:
+            m = p.match(url)
+            if m and m.groupdict().get('id'):
+                return f'{self.platform}:{m["id"]}'
+        return None
+
     @property
     def name(self) -> str:
         return self.__class__.__name__
@@ -27,39 +76,197 @@ class HandlerError(Exception):
     pass
 
 
+class SharedFailureError(HandlerError):
+    """Raised to the updates that joined a flight that failed, only the update that started it reports the error."""
+
+
+async def join_flight[T](
+    flights: SingleFlight[T],
+    key: str,
+    factory: Callable[[], Coroutine[Any, Any, T]],
+    max_wait: float | None = None,
+) -> T:
+    """`flights.do`, raising a `SharedFailureError` to everyone but the owner when the flight fails."""
+    owner = key not in flights
+    try:
+        return await flights.do(key, factory, max_wait)
+    except TimeoutError:
+        raise  # ran out of `max_wait`, that is this update's own
+    except Exception as e:
+        if owner:
+            raise
+        raise SharedFailureError(f'{flights.name} of {key} failed: {e}') from e
+
+
 async def inline_dl(update: Update, context: DelinkifyContext) -> None:
     if update.inline_query is None:
         return
     url = update.inline_query.query.strip()
     if not url.startswith('https://'):
         return
+    url = canonicalize(url)
     logger.debug(f'received query: {url}')
+    # following a short link takes from the same deadline as resolving it
+    deadline = time.monotonic() + context.config.inline_deadline
+    if context.short_links is not None:
+        try:
+            async with asyncio.timeout(context.config.inline_deadline):
+                url = await context.short_links.resolve(url)
+        except TimeoutError:
+            logger.info(f'could not follow {url} within {context.config.inline_deadline}s, answering later')
+            await reply_pending(update, context, url)
+            return
 
     mc = context.cache.get_by_url(url)
+    # failures can outlive the collection they came from, like a video that does not shrink enough
+    if (mc is None or not mc.is_materialized) and (failure := context.failures.get(url)):
+        logger.debug(f'refusing {url}, it failed recently: {failure.failure}')
+        await reply_unable(update, context, url, failure.failure)
+        return
     if mc is None:
-        handlers = context.router.get_handlers(url)
-        if not handlers:
-            await reply_unable(update, context, url)
+        try:
+            max_wait = max(deadline - time.monotonic(), 0)
+            mc = await join_flight(context.resolving, url, lambda: resolve(url, context), max_wait=max_wait)
+        except TimeoutError:
+            # the flight keeps going in the background and fills the cache for the next query
+            logger.info(f'could not resolve {url} within {context.config.inline_deadline}s, answering later')
+            await reply_pending(update, context, url)
             return
-        for handler in handlers:
-            logger.trace(f'trying handler {handler.name} for {url}')
-            try:
-                mc = await handler.handle(url, context)
-            except Exception as e:
-                raise HandlerError(f'handler {handler.name} failed: {e}')
-            if len(mc):
-                logger.debug(f'obtained {len(mc)} media')
-                break
-            logger.debug(f'handler {handler.name} did not return media')
-        else:
-            logger.warning(f'all handlers failed to delinkify {url}')
+        except HandlerError:
             await reply_unable(update, context, url)
-            return
+            raise
+    if mc is None:
+        await reply_unable(update, context, url)
+        return
 
-    context.cache.set(url, mc)
+    if context.prefetcher is not None and not mc.is_materialized:
+        context.prefetcher.submit(mc, lambda m: prefetch(m, context))
+        # do not let telegram cache placeholders, the next query may get the uploaded media
+        await update.inline_query.answer(results=mc.results(context), cache_time=0)
+        return
     await update.inline_query.answer(results=mc.results(context))
 
 
+async def resolve(url: str, context: DelinkifyContext) -> MediaCollection | None:
+    """Try the matching handlers in order of weight, return the first non-empty collection."""
+    with stage_seconds.time(stage='route', handler=''):
+        handlers = context.router.get_handlers(url)
+    if not handlers:
+        return None
+    if context.config.hedge and len(handlers) > 1:
+        mc = await resolve_hedged(url, handlers, context)
+    else:
+        mc = await resolve_sequential(url, handlers, context)
+    if mc is None:
+        logger.warning(f'all handlers failed to delinkify {url}')
+        context.failures.record(url, classify(None))
+        return None
+
+    context.failures.clear(url)
+    context.cache.set(url, mc)
+    await mc.fingerprint(context)
+    return mc
+
+
+async def run_handler(handler: Handler, url: str, context: DelinkifyContext) -> MediaCollection:
+    """Resolve `url` with `handler`, timing the runs that return media."""
+    logger.trace(f'trying handler {handler.name} for {url}')
+    start = time.monotonic()
+    mc = None
+    if context.config.metadata_first:
+        with stage_seconds.time(stage='extract', handler=handler.name):
+            mc = await handler.probe(url, context)
+    if mc is None:
+        # extraction and download in one go
+        with stage_seconds.time(stage='handle', handler=handler.name):
+            mc = await handler.handle(url, context)
+        await count_downloaded(handler, mc)
+    if len(mc):
+        context.latencies.observe(handler.name, time.monotonic() - start)
+    else:
+        logger.debug(f'handler {handler.name} did not return media')
+    return mc
+
+
+async def count_downloaded(handler: Handler, mc: MediaCollection) -> None:
+    paths = [m.source for m in mc.media.values() if not m.is_materialized]
+    downloaded_bytes.inc(await asyncio.to_thread(total_size, paths), handler=handler.name)
+
+
+async def resolve_sequential(url: str, handlers: list[Handler], context: DelinkifyContext) -> MediaCollection | None:
+    for handler in handlers:
+        try:
+            mc = await run_handler(handler, url, context)
+        except Exception as e:
+            context.failures.record(url, classify(e))
+            raise HandlerError(f'handler {handler.name} failed: {e}')
+        if len(mc):
+            logger.debug(f'obtained {len(mc)} media')
+            return mc
+    return None
+
+
+async def resolve_hedged(url: str, handlers: list[Handler], context: DelinkifyContext) -> MediaCollection | None:
+    """Start the next handler whenever the last one started runs past its p95, the first with media wins.
+
+    Handlers that fail or return nothing make way for the next one right away. The others are
+    cancelled once there is a winner, their files are removed once the extractor call they were
+    running in the executor is over.
+    """
+    waiting = list(handlers)
+    running: dict[asyncio.Task[MediaCollection], Handler] = {}
+    errors: list[tuple[Handler, BaseException]] = []
+    winner: MediaCollection | None = None
+    deadline = 0.0
+    try:
+        while winner is None and (waiting or running):
+            if waiting and (not running or time.monotonic() >= deadline):
+                handler = waiting.pop(0)
+                if running:
+                    slow = ', '.join(h.name for h in running.values())
+                    logger.info(f'{slow} running past its p95 for {url}, hedging with {handler.name}')
+                running[asyncio.create_task(run_handler(handler, url, context))] = handler
+                deadline = time.monotonic() + context.latencies.threshold(handler.name)
+            timeout = max(deadline - time.monotonic(), 0) if waiting else None
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                handler = running.pop(task)
+                if (e := task.exception()) is not None:
+                    logger.warning(f'handler {handler.name} failed for {url}: {e}')
+                    errors.append((handler, e))
+                elif len(mc := task.result()) and winner is None:
+                    logger.debug(f'obtained {len(mc)} media from {handler.name}')
+                    winner = mc
+                deadline = 0.0  # the next handler need not wait for one that is done
+    finally:
+        for task, handler in running.items():
+            task.cancel()
+            # not awaited, the task only ends along with a download already running in its thread
+            task.add_done_callback(functools.partial(_discard_loser, url, handler, context))
+        finished = [media_dir_for(url, h.name) for h in handlers if h not in waiting and h not in running.values()]
+        losers = [context.config.media_path / d for d in finished if winner is None or d != winner.media_dir]
+        await asyncio.to_thread(_remove_dirs, losers)
+
+    if winner is None and errors:
+        handler, e = errors[0]
+        context.failures.record(url, classify(e))
+        raise HandlerError(f'handler {handler.name} failed: {e}')
+    return winner
+
+
+def _discard_loser(url: str, handler: Handler, context: DelinkifyContext, task: asyncio.Task) -> None:
+    if not task.cancelled() and (e := task.exception()) is not None:
+        logger.debug(f'handler {handler.name} failed for {url} after losing: {e}')
+    logger.debug(f'cancelled handler {handler.name} for {url}, removing its files')
+    path = context.config.media_path / media_dir_for(url, handler.name)
+    asyncio.get_running_loop().run_in_executor(None, _remove_dirs, [path])
+
+
+def _remove_dirs(paths: list[Path]) -> None:
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 async def chosen_inline(update, context: DelinkifyContext):
     result_id = update.chosen_inline_result.result_id
     inline_message_id = update.chosen_inline_result.inline_message_id
@@ -72,16 +279,118 @@ async def chosen_inline(update, context: DelinkifyContext):
     if m is None:
         raise HandlerError(f'no media for {result_id} in cache')
 
+    if m.is_materialized:
+        logger.debug(f'updating message {inline_message_id}')
+        await m.update_message(context, inline_message_id)
+        return
+
+    assert m.url is not None
+    if failure := context.failures.get(m.url):
+        raise HandlerError(f'refusing {m.url}, it failed recently: {failure.failure}')
+
+    if result_id in context.materializing:
+        # a prefetch may have queued the transcode in the background, somebody is waiting now
+        context.transcoder.bump(m.shrunk_path)
+    mc = context.cache.get_by_url(m.url)
+    position = list(mc.media).index(result_id) if mc and result_id in mc.media else 0
+    job = context.jobs.add(result_id, inline_message_id, m.url, position)
+    try:
+        await context.jobs.run(job)
+    except SharedFailureError:
+        raise
+    except Exception as e:
+        raise HandlerError(f'materialization failed: {e}')
+
+
+async def run_job(job: Job, context: DelinkifyContext) -> None:
+    """Deliver a chosen result: get its media materialized, then edit the inline message to show it.
+
+    Jobs resumed after a restart may find their collection evicted from the cache, the link is
+    resolved again and the media at the same position is used.
+    """
+    m = context.cache.get_by_result_id(job.result_id)
+    if m is None:
+        context.jobs.advance(job, JobState.RESOLVE)
+        mc = context.cache.get_by_url(job.url) or await join_flight(
+            context.resolving, job.url, lambda: resolve(job.url, context)
+        )
+        if mc is None or job.position >= len(mc):
+            raise HandlerError(f'{job.url} no longer has media #{job.position}')
+        m = list(mc.media.values())[job.position]
+
     if not m.is_materialized:
-        logger.debug(f'materializing media for result_id {result_id}')
         try:
-            await m.materialize(context, inline_message_id)
-            context.cache.mark_modified()
+            m = await join_flight(context.materializing, m.result_id, lambda: ensure_materialized(m, context, job=job))
         except Exception as e:
-            raise HandlerError(f'materialization failed: {e}')
+            # the file will not get any smaller, refuse the link once it is resolved again
+            if not isinstance(e, SharedFailureError) and (failure := classify(e)) == FailureClass.TOO_LARGE:
+                context.failures.record(job.url, failure)
+            raise
+
+    context.jobs.advance(job, JobState.EDIT_MESSAGE)
+    logger.debug(f'updating message {job.inline_message_id}')
+    await m.update_message(context, job.inline_message_id)
+
+
+async def ensure_materialized(
+    m: Media,
+    context: DelinkifyContext,
+    priority: Priority = Priority.INTERACTIVE,
+    job: Job | None = None,
+    upload_rest: bool = True,
+) -> Media:
+    """Download if needed, transcode and upload `m` to the dump chat, unless an earlier flight already did.
+
+    With `upload_rest`, the other pending media of its collection are then uploaded as albums
+    in the background, `m` does not wait for them.
+    """
+    if m.is_materialized:
+        return m
+    assert m.url is not None
+    mc = context.cache.get_by_url(m.url)
+    if not m.is_downloaded:
+        if mc is None:
+            raise HandlerError(f'no collection for {m.result_id} in cache')
+        context.jobs.advance(job, JobState.DOWNLOAD)
+        await context.downloading.do(mc.media_dir, lambda: ensure_downloaded(mc, context))
+        m = mc.media.get(m.result_id, m)
+    logger.debug(f'materializing media for result_id {m.result_id}')
+    context.jobs.advance(job, JobState.TRANSCODE)
+    await m.prepare(context, priority)
+    context.jobs.advance(job, JobState.UPLOAD)
+    await m.upload(context)
+    context.cache.mark_modified(m)
+    if upload_rest and mc is not None and context.config.album_uploads and mc.pending:
+        logger.debug(f'materializing the other {len(mc.pending)} media of {mc.url} as albums')
+        context.uploading.start(mc.media_dir, lambda: mc.materialize(context, Priority.BACKGROUND))
+    return m
+
+
+async def prefetch(m: Media, context: DelinkifyContext) -> Media:
+    """Materialize `m` before it is chosen, a user choosing it meanwhile joins the same flight."""
+    m = context.cache.get_by_result_id(m.result_id) or m
+    if m.is_materialized:
+        return m
+    # the prefetcher picks the media of a gallery it uploads itself
+    return await context.materializing.do(
+        m.result_id, lambda: ensure_materialized(m, context, Priority.BACKGROUND, upload_rest=False)
+    )
 
-    logger.debug(f'updating message {inline_message_id}')
-    await m.update_message(context, inline_message_id)
+
+async def ensure_downloaded(mc: MediaCollection, context: DelinkifyContext) -> None:
+    """Run the deferred download of a collection resolved through `Handler.probe`."""
+    if mc.is_downloaded:
+        return
+    handler = context.router.get_handler(mc.handler) if mc.handler else None
+    if handler is None:
+        raise HandlerError(f'no handler to download {mc.url} (resolved by {mc.handler})')
+    logger.debug(f'downloading {mc.url} with handler {handler.name}')
+    with stage_seconds.time(stage='download', handler=handler.name):
+        await handler.download(mc, context)
+    await count_downloaded(handler, mc)
+    for m in mc.media.values():
+        context.cache.mark_modified(m)
+    await mc.fingerprint(context)
 
 
 def _replace_html_entities(src: str | Exception) -> str:
@@ -103,6 +412,10 @@ async def error_handler(update: object, context: DelinkifyContext) -> None:
         logger.warning(f'network error: {context.error}')
         return
 
+    if isinstance(context.error, SharedFailureError):
+        logger.info(f'not reporting an error already reported by another update: {context.error}')
+        return
+
     logger.opt(exception=context.error).error('exception while handling an update')
 
     chat_id_errors = context.config.errors_chat_id
@@ -145,7 +458,30 @@ async def error_handler(update: object, context: DelinkifyContext) -> None:
     )
 
 
-async def reply_unable(update: Update, context: DelinkifyContext, url: str) -> None:
+async def reply_pending(update: Update, context: DelinkifyContext, url: str) -> None:
+    if update.inline_query is None:
+        return
+    await update.inline_query.answer(
+        results=[
+            InlineQueryResultArticle(
+                id='pending',
+                title='Still working on it...',
+                description='Try again in a few seconds',
+                input_message_content=InputTextMessageContent(
+                    f'I am still delinkifying {url}, try again in a few seconds!'
+                ),
+            )
+        ],
+        cache_time=0,
+    )
+
+
+async def reply_unable(
+    update: Update,
+    context: DelinkifyContext,
+    url: str,
+    failure: FailureClass | None = None,
+) -> None:
     if update.inline_query is None:
         return
     await update.inline_query.answer(
@@ -153,6 +489,7 @@ async def reply_unable(update: Update, context: DelinkifyContext, url: str) -> N
             InlineQueryResultArticle(
                 id='error',
                 title='Unable to delinkify that',
+                description=f'Reason: {failure}' if failure else None,
                 input_message_content=InputTextMessageContent(
                     f'I could not delinkify {url}, check it out manually if you are '
                     'OK with feeding the capitalist machine, you monster!'
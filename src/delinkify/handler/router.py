@@ -1,33 +1,55 @@
+import functools
 import inspect
-import re
 from importlib.util import module_from_spec, spec_from_file_location
 from pathlib import Path
 from typing import Any
-from urllib.parse import urlparse
+from urllib.parse import urlsplit
 
 from loguru import logger
 
 from delinkify.handler import Handler
+from delinkify.util.url import canonicalize
+
+LOOKUP_CACHE_SIZE = 4096
+
+
+def registrable_domain(host: str) -> str:
+    # good enough for the sites we handle, public suffixes like co.uk would need a suffix list
+    return '.'.join(host.rsplit('.', 2)[-2:])
 
 
 class Router:
-    def __init__(self) -> None:
+    def __init__(self, handlers: list[type[Handler]] | None = None) -> None:
         self.handlers: list[Handler] = []
-        self.load_handlers()
+        self._by_domain: dict[str, tuple[Handler, ...]] = {}
+        self._any_domain: tuple[Handler, ...] = ()
+        self._lookup = functools.lru_cache(maxsize=LOOKUP_CACHE_SIZE)(self.match_handlers)
+        if handlers is None:
+            self.load_handlers()
+        else:
+            for handler in handlers:
+                self.register_handler(handler)
+        self.build_index()
 
     def register_handler(self, handler: type[Handler]) -> None:
         h = handler()
         w = h.weight if h.weight >= 0 else 'disabled'
+        if not h.patterns:  # compiles the patterns once, at load time
+            raise ValueError(f'handler {h.name} has no url patterns')
         self.handlers.append(h)
         logger.info(f'registered handler {h.name} with weight {w} for urls like {handler.url_patterns}')
 
+    def build_index(self) -> None:
+        """Index the enabled handlers by domain, each bucket already in weight order."""
+        enabled = sorted((h for h in self.handlers if h.weight >= 0), key=lambda h: h.weight, reverse=True)
+        self._any_domain = tuple(h for h in enabled if not h.domains)
+        domains = {d for h in enabled for d in h.domains}
+        self._by_domain = {d: tuple(h for h in enabled if d in h.domains or not h.domains) for d in domains}
+        self._lookup.cache_clear()
+
     def is_handler(self, obj: Any, module: Any) -> bool:
         return inspect.isclass(obj) and issubclass(obj, Handler) and obj.__module__ == module.__name__
 
-    def is_valid_url(self, url: str) -> bool:
-        result = urlparse(url)
-        return all([result.netloc, result.path])
-
     def load_handlers(self) -> None:
         logger.info('loading handlers...')
         handler_dir = Path(__file__).parent.parent / 'handlers'
@@ -42,17 +64,28 @@ class Router:
                 if self.is_handler(obj, module):
                     self.register_handler(obj)
 
+    def get_handler(self, name: str) -> Handler | None:
+        return next((h for h in self.handlers if h.name == name), None)
+
     def get_handlers(self, url: str) -> list[Handler]:
-        valid_handlers: list[Handler] = []
-        if not self.is_valid_url(url):
+        return list(self._lookup(url))
+
+    def match_handlers(self, url: str) -> tuple[Handler, ...]:
+        """Uncached lookup, `get_handlers` memoizes it for repeated urls."""
+        parts = urlsplit(url)
+        if not parts.netloc or not parts.path:
             logger.warning(f'invalid url: {url}')
-            return []
-        enabled_handlers = [h for h in self.handlers if h.weight >= 0]
-        for h in enabled_handlers:
-            for p in h.url_patterns:
-                if re.match(p, url):
-                    valid_handlers.append(h)
-                    break
-        valid_handlers = sorted(valid_handlers, key=lambda h: h.weight, reverse=True)
+            return ()
+        candidates = self._by_domain.get(registrable_domain(parts.hostname or ''), self._any_domain)
+        valid_handlers = tuple(h for h in candidates if h.matches(url))
         logger.trace(f'handlers for {url}: {[h.name for h in valid_handlers]}')
         return valid_handlers
+
+    def cache_key(self, url: str) -> str:
+        """Cache key for `url`: the first key a matching handler provides, or the canonical url."""
+        url = canonicalize(url)
+        for h in self.get_handlers(url):
+            key = h.canonical_key(url)
+            if key is not None:
+                return key
+        return url
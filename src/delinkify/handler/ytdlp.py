@@ -0,0 +1,131 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import Any
+
+from loguru import logger
+
+from delinkify.context import DelinkifyContext
+from delinkify.handler.handler import Handler
+from delinkify.media import Media, MediaCollection
+from delinkify.util import (
+    log_throughput,
+    ydl_download,
+    ydl_download_info,
+    ydl_download_streams,
+    ydl_pipe_command,
+    ydl_probe,
+)
+from delinkify.util.formats import MAX_DOWNLOAD_MB, FormatSelector, stream_urls, video_info
+from delinkify.util.video import MAX_VIDEO_SIZE_MB, Action, pipe_transcode, plan_transcode, stream_transcode
+
+
+class YtdlpHandler(Handler):
+    """Base for handlers that fetch a single video through yt-dlp.
+
+    Unless a handler sets its own `format`, the rendition is picked by a `FormatSelector`. With
+    streaming enabled, formats that need a transcode are transcoded while they download. How
+    the files are downloaded is set by the handler's `DownloadEngine` in the config.
+    """
+
+    ydl_params: dict[str, Any]
+    caption_fields = ['description', 'title']
+
+    def params(self, mc: MediaCollection, context: DelinkifyContext) -> dict[str, Any]:
+        engine = context.config.engine_for(self.name)
+        merge_ext = self.ydl_params.get('merge_output_format', 'mp4')
+        defaults = {
+            'format': FormatSelector(merge_ext=merge_ext),
+            'merge_output_format': merge_ext,
+            'max_filesize': MAX_DOWNLOAD_MB * 1024 * 1024,
+            'concurrent_fragment_downloads': engine.fragments,
+            'http_chunk_size': engine.chunk_mb * 1024 * 1024 or None,
+            'progress_hooks': [log_throughput],
+        }
+        # relative, the pooled instance puts it under the media path of each request
+        return defaults | self.ydl_params | {'outtmpl': '%(id)s.%(ext)s'}
+
+    def caption(self, info: dict[str, Any], source: Path) -> str:
+        return next((info[f] for f in self.caption_fields if info.get(f)), source.name)
+
+    def log_download(self, info: dict[str, Any], source: Path) -> None:
+        if 'requested_formats' in info:
+            vcodec = next((f.get('vcodec') for f in info['requested_formats'] if f.get('vcodec')), 'unknown')
+            format_id = '+'.join(f['format_id'] for f in info['requested_formats'])
+        else:
+            vcodec = info.get('vcodec', 'unknown')
+            format_id = info.get('format_id', 'unknown')
+        logger.info(f'downloaded video size: {source.stat().st_size} bytes, codec: {vcodec}, format: {format_id}')
+
+    async def fetch(self, url: str, mc: MediaCollection, context: DelinkifyContext) -> tuple[dict[str, Any], Path]:
+        params, media_path = self.params(mc, context), mc.get_media_path(context)
+        parallel_streams = context.config.engine_for(self.name).parallel_streams
+        if context.config.streaming == 'off' and not parallel_streams:
+            return await context.executor.run(self.name, ydl_download, self.name, url, params, media_path)
+        info, source = await context.executor.run(self.name, ydl_probe, self.name, url, params, media_path)
+        if context.config.streaming != 'off':
+            streamed = await self.stream(info, source, context)
+            if streamed is not None:
+                return info, streamed
+        if parallel_streams and len(info.get('requested_formats') or []) > 1:
+            return await context.executor.run(self.name, ydl_download_streams, self.name, info, params, media_path)
+        return await context.executor.run(self.name, ydl_download_info, self.name, info, params, media_path)
+
+    async def stream(self, info: dict[str, Any], source: Path, context: DelinkifyContext) -> Path | None:
+        """Transcode the selected format as it downloads, if it needs a transcode at all.
+
+        Returns the transcoded file, or None when the format should be downloaded as usual.
+        """
+        video = video_info(info)
+        plan = plan_transcode(video, MAX_VIDEO_SIZE_MB * 1024 * 1024) if video else None
+        if video is None or plan is None or plan.action not in {Action.AUDIO, Action.ENCODE}:
+            return None
+        output_path = source.with_suffix('.mp4')
+
+        if context.config.streaming == 'direct':
+            urls = stream_urls(info)
+            if urls is None:
+                logger.debug(f'cannot stream {source.name} directly, protocol {info.get("protocol")}')
+                return None
+
+            def work(threads: int) -> Any:
+                return stream_transcode(plan, video, urls, output_path, threads=threads)
+
+        else:
+            info_path = source.with_suffix('.info.json')
+            await asyncio.to_thread(info_path.write_text, json.dumps(info))
+            cmd = ydl_pipe_command(info_path, info['format_id'])
+
+            def work(threads: int) -> Any:
+                return pipe_transcode(plan, video, cmd, output_path, threads=threads)
+
+        logger.info(f'streaming {source.name} ({context.config.streaming}) into {plan}')
+        try:
+            return await context.transcoder.run(output_path.name, output_path, work)
+        except Exception as e:
+            logger.opt(exception=e).warning(f'streaming transcode of {source.name} failed, downloading instead')
+            return None
+
+    async def handle(self, url: str, context: DelinkifyContext) -> MediaCollection:
+        mc = MediaCollection(url=url, handler=self.name)
+        info, source = await self.fetch(url, mc, context)
+        self.log_download(info, source)
+        mc.add_media(Media(source=source, caption=self.caption(info, source)), context)
+        return mc
+
+    async def probe(self, url: str, context: DelinkifyContext) -> MediaCollection | None:
+        mc = MediaCollection(url=url, handler=self.name)
+        info, source = await context.executor.run(
+            self.name, ydl_probe, self.name, url, self.params(mc, context), mc.get_media_path(context)
+        )
+        mc.add_media(
+            Media(source=source, caption=self.caption(info, source), thumbnail_url=info.get('thumbnail')),
+            context,
+        )
+        return mc
+
+    async def download(self, mc: MediaCollection, context: DelinkifyContext) -> None:
+        info, source = await self.fetch(mc.url, mc, context)
+        self.log_download(info, source)
+        for m in mc.media.values():
+            m.source = source
@@ -1,43 +1,16 @@
-import json
+from delinkify.handler.gallerydl import GalleryDLHandler
 
-import gallery_dl
 
-from delinkify.context import DelinkifyContext
-from delinkify.handler import Handler
-from delinkify.media import Media, MediaCollection
-from delinkify.util import gdl, get_cookie_file_path
-
-
-class TiktokGalleryDL(Handler):
+class TiktokGalleryDL(GalleryDLHandler):
     """Handler for delinkifying TikTok posts using gallery-dl."""
 
     url_patterns = [
         r'^https://(www.|vm.)?tiktok.com/[\w-]+',
-        r'^https://(www.|vm.)?tiktok.com/@[\w-]+/video/\d+',
+        r'^https://(www.|vm.)?tiktok.com/@[\w-]+/video/(?P<id>\d+)',
     ]
+    domains = ['tiktok.com']
     weight = 500
+    platform = 'tiktok'
 
-    gallery_dl.config.set(('extractor', 'tiktok'), 'directory', [])
-    gallery_dl.config.set(('extractor', 'tiktok'), 'filename', '{id}_{num:>02}.{extension}')
-
-    async def handle(self, url: str, context: DelinkifyContext) -> MediaCollection:
-        mc = MediaCollection(url=url)
-        media_path = mc.get_media_path(context)
-        job = gdl(
-            url,
-            media_path,
-            cookie_file_path=get_cookie_file_path('tiktok', context),
-        )
-        job.run()
-
-        caption = None
-        meta_file = media_path / 'metadata.json'
-        if meta_file.exists():
-            meta = json.loads(meta_file.read_text())
-            caption = meta.get('description') or meta.get('title')
-
-        for f in media_path.rglob('*'):
-            if f.is_file() and f.suffix != '.json':
-                mc.add_media(Media(source=f, caption=caption or f.name), context)
-
-        return mc
+    category = 'tiktok'
+    cookie_name = 'tiktok'
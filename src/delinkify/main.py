@@ -1,13 +1,31 @@
+import asyncio
+from datetime import datetime
 from importlib.metadata import version
+from urllib.parse import urlsplit
 
 from loguru import logger
-from telegram.ext import Application, ChosenInlineResultHandler, ContextTypes, InlineQueryHandler
+from telegram import Update
+from telegram.ext import Application, ChosenInlineResultHandler, ContextTypes, InlineQueryHandler, TypeHandler
 
 from delinkify.config import Config
 from delinkify.context import DelinkifyContext
-from delinkify.handler.handler import chosen_inline, error_handler, inline_dl
+from delinkify.handler.handler import chosen_inline, error_handler, inline_dl, run_job
 from delinkify.handler.router import Router
 from delinkify.util.cache import Cache
+from delinkify.util.cache_backend import make_backend
+from delinkify.util.executor import DownloadExecutor
+from delinkify.util.http import HTTPServer, Request, Response
+from delinkify.util.janitor import Janitor
+from delinkify.util.jobs import JobQueue
+from delinkify.util.latency import LatencyTracker
+from delinkify.util.metrics import registry
+from delinkify.util.negative_cache import NegativeCache
+from delinkify.util.prefetcher import Prefetcher
+from delinkify.util.short_links import ShortLinkResolver
+from delinkify.util.singleflight import SingleFlight
+from delinkify.util.transcoder import Transcoder
+from delinkify.util.updates import DelinkifyUpdateProcessor
+from delinkify.util.webhook import Webhook
 
 config = Config.from_env()
 
@@ -15,6 +33,7 @@ config = Config.from_env()
 class DelinkifyBot:
     def __init__(self):
         ct = ContextTypes(context=DelinkifyContext)
+        router = Router()
         self.app = (
             Application
             .builder()
@@ -22,19 +41,150 @@ class DelinkifyBot:
             .read_timeout(60)
             .write_timeout(60)
             .context_types(ct)
+            .concurrent_updates(DelinkifyUpdateProcessor(config.concurrent_updates, key_fn=router.cache_key))
             .token(config.bot_token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
             .build()
         )
         self.app.bot_data['config'] = config
-        self.app.bot_data['router'] = Router()
-        self.app.bot_data['pending']: list[str] = []  # list of result_ids that are pending materialization
-        self.app.bot_data['cache'] = Cache(config.cache_path, config.cache_save_interval)
+        self.app.bot_data['router'] = router
+        self.app.bot_data['jobs'] = JobQueue(config.cache_path)
+        self.app.bot_data['cache'] = Cache(
+            make_backend(config.cache_backend, config.cache_path),
+            config.cache_save_interval,
+            config.cache_max_entries,
+            key_fn=router.cache_key,
+        )
+        self.app.bot_data['failures'] = NegativeCache(
+            config.cache_max_entries,
+            config.negative_cache_max_ttl,
+            key_fn=router.cache_key,
+        )
+        self.app.bot_data['latencies'] = LatencyTracker(config.hedge_delay)
+        self.app.bot_data['executor'] = DownloadExecutor(
+            config.executor_kind,
+            config.executor_workers,
+            config.executor_handler_limit,
+        )
+        self.app.bot_data['transcoder'] = Transcoder(config.transcode_workers, config.transcode_threads)
+        self.app.bot_data['prefetcher'] = (
+            Prefetcher(config.prefetch_workers, config.prefetch_items, config.prefetch_kbps)
+            if config.prefetch
+            else None
+        )
+        self.app.bot_data['short_links'] = (
+            ShortLinkResolver(config.short_link_ttl) if config.resolve_short_links else None
+        )
+        self.app.bot_data['resolving'] = SingleFlight('resolve')
+        self.app.bot_data['materializing'] = SingleFlight('materialize')
+        self.app.bot_data['downloading'] = SingleFlight('download')
+        self.app.bot_data['uploading'] = SingleFlight('upload')
+        self.janitor = Janitor(
+            self.app.bot_data['cache'],
+            self.app.bot_data['materializing'],
+            config.media_path,
+            interval=config.gc_interval,
+            ttl=config.cache_ttl,
+            grace=config.media_grace_period,
+            max_bytes=config.media_max_mb * 1024 * 1024,
+        )
+        self.metrics = HTTPServer(config.metrics_listen, config.metrics_port) if config.metrics_port else None
+        self.register_metrics()
         self.app.add_error_handler(error_handler)
         self.app.add_handler(InlineQueryHandler(inline_dl))
         self.app.add_handler(ChosenInlineResultHandler(chosen_inline))
 
+    def register_metrics(self) -> None:
+        """Expose the state of the queues and caches, read whenever the metrics are rendered."""
+        bot_data = self.app.bot_data
+        updates = self.app.update_processor
+        jobs = bot_data['jobs']
+        assert isinstance(updates, DelinkifyUpdateProcessor)
+        for name, description, fn in [
+            ('updates_running', 'Updates being processed', lambda: updates.running),
+            ('updates_waiting', 'Updates waiting for a free slot', lambda: updates.waiting),
+            ('jobs_depth', 'Unfinished delivery jobs', lambda: None if jobs.closed else jobs.depth),
+            (
+                'jobs_oldest_age_seconds',
+                'Age of the oldest unfinished job',
+                lambda: None if jobs.closed else jobs.oldest_age,
+            ),
+            ('executor_queued', 'Downloads waiting for a worker', lambda: bot_data['executor'].queue_depth),
+            ('executor_running', 'Downloads running', lambda: bot_data['executor'].running),
+            ('transcoder_queued', 'Transcodes waiting for a slot', lambda: bot_data['transcoder'].queue_depth),
+            ('transcoder_running', 'Transcodes running', lambda: bot_data['transcoder'].running),
+        ]:
+            registry.callback(f'delinkify_{name}', description, fn)
+        if (short_links := bot_data['short_links']) is not None:
+            registry.callback(
+                'delinkify_short_link_hits_total', 'Short links found resolved', lambda: short_links.hits, 'counter'
+            )
+            registry.callback(
+                'delinkify_short_link_misses_total', 'Short links followed', lambda: short_links.misses, 'counter'
+            )
+
+    async def serve_metrics(self, request: Request) -> Response:
+        return Response(body=registry.render().encode(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    async def post_init(self, app: Application) -> None:
+        await app.bot_data['cache'].rekey()
+        await app.bot_data['cache'].start()
+        await app.bot_data['transcoder'].start()
+        await self.janitor.remove_partials()
+        await app.bot_data['jobs'].start(lambda job: run_job(job, DelinkifyContext(app)))
+        if app.bot_data['prefetcher'] is not None:
+            await app.bot_data['prefetcher'].start()
+        await self.janitor.start()
+        if self.metrics is not None:
+            self.metrics.route('GET', '/metrics', self.serve_metrics)
+            await self.metrics.start()
+
+    async def post_shutdown(self, app: Application) -> None:
+        if self.metrics is not None:
+            await self.metrics.stop()
+        # before the queues are stopped, their gauges read from them
+        path = config.log_path / f'metrics-{datetime.now().strftime("%Y-%m-%d-%H%M%S")}.prom'
+        await asyncio.to_thread(registry.dump, path)
+        logger.info(f'metrics dumped to {path}')
+        await self.janitor.stop()
+        await app.bot_data['jobs'].stop()
+        if app.bot_data['prefetcher'] is not None:
+            await app.bot_data['prefetcher'].stop()
+        await app.bot_data['transcoder'].stop()
+        if app.bot_data['short_links'] is not None:
+            await app.bot_data['short_links'].close()
+        await app.bot_data['cache'].stop()
+
     def run(self):
-        self.app.run_polling()
+        if config.transport == 'webhook':
+            self.run_webhook()
+        else:
+            self.app.run_polling()
+
+    def run_webhook(self) -> None:
+        """Serve the updates telegram posts with python-telegram-bot's webhook server."""
+        webhook = Webhook(config.webhook_record_path)
+        # ahead of the other handlers, whose group is 0
+        self.app.add_handler(TypeHandler(Update, webhook.observe, block=False), group=-1)
+        registry.callback(
+            'delinkify_webhook_updates_total',
+            'Updates received through the webhook',
+            lambda: webhook.received,
+            'counter',
+        )
+        logger.info(f'receiving updates through the webhook at {config.webhook_url}')
+        try:
+            self.app.run_webhook(
+                listen=config.webhook_listen,
+                port=config.webhook_port,
+                url_path=urlsplit(config.webhook_url).path,
+                webhook_url=config.webhook_url,
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=config.webhook_secret,
+            )
+        finally:
+            webhook.close()
 
 
 def main() -> None:
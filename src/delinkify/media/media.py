@@ -1,5 +1,6 @@
-import hashlib
+import asyncio
 import mimetypes
+import time
 from pathlib import Path
 from uuid import uuid4
 
@@ -15,20 +16,32 @@ from telegram import (
     InputMediaVideo,
     InputTextMessageContent,
     LinkPreviewOptions,
+    Message,
 )
 
 from delinkify.context import DelinkifyContext
-from delinkify.util.video import MAX_VIDEO_SIZE_MB, shrink
+from delinkify.util.content import file_digest, link_duplicate, total_size
+from delinkify.util.metrics import stage_seconds, uploaded_bytes
+from delinkify.util.transcoder import Priority
+from delinkify.util.url import media_dir_for
+
+# most items telegram takes in one media group
+MEDIA_GROUP_SIZE = 10
 
 
 class MediaCollection:
     def __init__(
         self,
         url: str,
+        handler: str | None = None,
+        media_dir: str | None = None,
     ):
         self.url = url
+        self.handler = handler  # name of the handler that resolved this collection
         self.media: dict[str, Media] = {}
-        self.media_dir = hashlib.sha256(self.url.encode()).hexdigest()[:32]
+        self.media_dir = media_dir or media_dir_for(url, handler)
+        self.created_at = time.time()
+        self.accessed_at = self.created_at
 
     def __len__(self) -> int:
         return len(self.media)
@@ -54,19 +67,87 @@ class MediaCollection:
     def is_materialized(self) -> bool:
         return all(m.is_materialized for m in self.media.values())
 
+    @property
+    def is_downloaded(self) -> bool:
+        return all(m.is_materialized or m.is_downloaded for m in self.media.values())
+
+    async def fingerprint(self, context: DelinkifyContext) -> None:
+        """Fingerprint the downloaded media, see `Media.fingerprint`."""
+        for m in self.media.values():
+            if m.is_materialized or not m.is_downloaded:
+                continue
+            try:
+                await m.fingerprint(context)
+            except OSError as e:
+                logger.warning(f'could not fingerprint {m.source}: {e}')
+                continue
+            context.cache.mark_modified(m)
+
+    @property
+    def pending(self) -> list[Media]:
+        return [m for m in self.media.values() if not m.is_materialized]
+
+    async def materialize(self, context: DelinkifyContext, priority: Priority = Priority.INTERACTIVE) -> None:
+        """Upload every media that is not materialized yet, as albums of up to `MEDIA_GROUP_SIZE` items.
+
+        Media that fail to prepare or upload stay unmaterialized, as do media somebody chose
+        meanwhile: their own flight uploads them. The collection is written to the cache once,
+        after every album has been uploaded.
+        """
+        pending = self.pending
+        results = await asyncio.gather(*(m.prepare(context, priority) for m in pending), return_exceptions=True)
+        for m, result in zip(pending, results, strict=True):
+            if isinstance(result, Exception):
+                logger.warning(f'leaving {m.result_id} out of the albums for {self.url}: {result}')
+        ready = [
+            m
+            for m, result in zip(pending, results, strict=True)
+            if result is None and not m.is_materialized and m.result_id not in context.materializing
+        ]
+        groups = [ready[i : i + MEDIA_GROUP_SIZE] for i in range(0, len(ready), MEDIA_GROUP_SIZE)]
+        logger.debug(f'uploading {len(ready)} media of {self.url} in {len(groups)} albums')
+        uploads = await asyncio.gather(*(self._upload_group(g, context) for g in groups), return_exceptions=True)
+        for group, result in zip(groups, uploads, strict=True):
+            if isinstance(result, Exception):
+                logger.warning(f'album of {len(group)} media for {self.url} failed to upload: {result}')
+        context.cache.set(self.url, self)
+
+    async def _upload_group(self, group: list[Media], context: DelinkifyContext) -> None:
+        if len(group) == 1:  # media groups need at least two items
+            await group[0].upload(context)
+            return
+        with stage_seconds.time(stage='upload', handler=''):
+            messages = await context.bot.send_media_group(
+                context.config.dump_chat_id,
+                [m.as_input_media() for m in group],
+                write_timeout=600,
+            )
+        for m, message in zip(group, messages, strict=True):
+            m.set_uploaded(message)
+            await m.count_uploaded()
+
     def results(self, context: DelinkifyContext) -> list[InlineQueryResult]:
         return [media.as_result(context) for media in self.media.values()]
 
     def to_dict(self) -> dict:
         return {
             'url': self.url,
+            'handler': self.handler,
+            'media_dir': self.media_dir,
             'media': {result_id: m.to_dict() for result_id, m in self.media.items()},
+            'created_at': self.created_at,
+            'accessed_at': self.accessed_at,
         }
 
     @classmethod
     def from_dict(cls, data: dict) -> MediaCollection:
-        mc = cls(url=data['url'])
+        # entries written before the directory was stored used one per url, whatever the handler
+        media_dir = data.get('media_dir') or media_dir_for(data['url'])
+        mc = cls(url=data['url'], handler=data.get('handler'), media_dir=media_dir)
         mc.media = {result_id: Media.from_dict(m) for result_id, m in data['media'].items()}
+        # entries written before timestamps were tracked count as brand new
+        mc.created_at = data.get('created_at') or mc.created_at
+        mc.accessed_at = data.get('accessed_at') or mc.accessed_at
         return mc
 
 
@@ -75,11 +156,14 @@ class Media:
         self,
         source: Path,
         caption: str | None = None,
+        thumbnail_url: str | None = None,
     ):
         self.source = Path(source)
         self.caption = caption or 'Some unknown media'
+        self.thumbnail_url = thumbnail_url
         self.file_id: str | None = None
         self.url: str | None = None
+        self.digest: str | None = None  # hash of the downloaded file, before any transcoding
         self.result_id = uuid4().hex
 
     def __str__(self) -> str:
@@ -92,6 +176,20 @@ class Media:
     def is_materialized(self) -> bool:
         return self.file_id is not None
 
+    @property
+    def is_downloaded(self) -> bool:
+        return self.source.exists()
+
+    @property
+    def kind(self) -> str | None:
+        """Top level mime type, e.g. 'video', None when unknown."""
+        mime_type, _ = mimetypes.guess_type(self.source)
+        return mime_type.partition('/')[0] if mime_type else None
+
+    @property
+    def shrunk_path(self) -> Path:
+        return self.source.with_stem(f'{self.source.stem}-shrunk').with_suffix('.mp4')
+
     @property
     def mime_type(self) -> str:
         mime_type, _ = mimetypes.guess_type(self.source)
@@ -99,31 +197,80 @@ class Media:
             raise ValueError(f'could not determine mimetype for {self.source}')
         return mime_type
 
-    async def materialize(self, context: DelinkifyContext, inline_message_id: str) -> None:
-        if self.mime_type.startswith('video/'):
-            if self.source.stat().st_size > MAX_VIDEO_SIZE_MB * 1024 * 1024:
-                new_source = Path(f'{self.source.with_suffix("")}-shrunk{self.source.suffix}')
-                await shrink(self.source, new_source)
+    async def fingerprint(self, context: DelinkifyContext) -> None:
+        """Hash the downloaded file and look for other media with the same bytes.
+
+        If that media was already uploaded its file_id is taken over, otherwise this file is
+        replaced by a hard link to the other one so the content is only stored once.
+        """
+        if self.digest is None:
+            self.digest = await asyncio.to_thread(file_digest, self.source)
+        twin = context.cache.get_by_digest(self.digest)
+        if twin is None or twin.result_id == self.result_id or twin.kind != self.kind:
+            return
+        if twin.is_materialized:
+            logger.info(f'{self.url} has the same content as {twin.url}, reusing its file_id')
+            self.file_id = twin.file_id
+        else:
+            await asyncio.to_thread(link_duplicate, self.source, twin.source)
+
+    async def prepare(self, context: DelinkifyContext, priority: Priority = Priority.INTERACTIVE) -> None:
+        """Get the file ready for upload, shrinking videos. Duplicates take over a file_id instead."""
+        await self.fingerprint(context)
+        if self.is_materialized:
+            return
+        if self.mime_type.startswith('video/') and not self.source.stem.endswith('-shrunk'):
+            new_source = self.shrunk_path
+            if new_source.exists():
+                logger.debug(f'reusing shrunk video {new_source}')
                 self.source = new_source
-            logger.debug(f'uploading video {self.source} with mime type {self.mime_type}')
-            m = await context.bot.send_video(
-                context.config.dump_chat_id,
-                self.source,
-                caption=self.url or self.caption[:1024],
-                write_timeout=600,
-            )
-            if not m.video:
+            else:
+                self.source = await context.transcoder.shrink(self.source, new_source, priority)
+        elif not self.mime_type.startswith('image/'):
+            raise ValueError(f'unsupported mimetype: {self.mime_type}')
+
+    async def upload(self, context: DelinkifyContext) -> None:
+        """Upload the file `prepare` got ready to the dump chat and take its file_id."""
+        if self.is_materialized:
+            return
+        with stage_seconds.time(stage='upload', handler=''):
+            if self.mime_type.startswith('video/'):
+                logger.debug(f'uploading video {self.source} with mime type {self.mime_type}')
+                m = await context.bot.send_video(
+                    context.config.dump_chat_id,
+                    self.source,
+                    caption=self.url or self.caption[:1024],
+                    write_timeout=600,
+                )
+            else:
+                m = await context.bot.send_photo(
+                    context.config.dump_chat_id,
+                    self.source,
+                    caption=self.url or self.caption[:1024],
+                )
+        self.set_uploaded(m)
+        await self.count_uploaded()
+
+    async def count_uploaded(self) -> None:
+        uploaded_bytes.inc(await asyncio.to_thread(total_size, [self.source]), kind=self.mime_type.split('/')[0])
+
+    def as_input_media(self) -> InputMediaVideo | InputMediaPhoto:
+        """Describe the prepared file as an item of a media group."""
+        caption = self.url or self.caption[:1024]
+        if self.mime_type.startswith('video/'):
+            return InputMediaVideo(media=self.source, caption=caption)
+        return InputMediaPhoto(media=self.source, caption=caption)
+
+    def set_uploaded(self, message: Message) -> None:
+        """Take the file_id from the dump chat message this media was uploaded in."""
+        if self.mime_type.startswith('video/'):
+            if not message.video:
                 raise ValueError('video upload failed')
-            self.file_id = m.video.file_id
-        elif self.mime_type.startswith('image/'):
-            m = await context.bot.send_photo(
-                context.config.dump_chat_id,
-                self.source,
-                caption=self.url or self.caption[:1024],
-            )
-            self.file_id = m.photo[-1].file_id
+            self.file_id = message.video.file_id
         else:
-            raise ValueError(f'unsupported mimetype: {self.mime_type}')
+            if not message.photo:
+                raise ValueError('photo upload failed')
+            self.file_id = message.photo[-1].file_id
 
     async def update_message(self, context: DelinkifyContext, inline_message_id: str) -> None:
         if self.file_id is None:
@@ -134,10 +281,11 @@ class Media:
             media = InputMediaPhoto(media=self.file_id, caption=self.caption[:1024])
         else:
             raise ValueError(f'unsupported mimetype: {self.mime_type}')
-        await context.bot.edit_message_media(
-            media=media,
-            inline_message_id=inline_message_id,
-        )
+        with stage_seconds.time(stage='edit_message', handler=''):
+            await context.bot.edit_message_media(
+                media=media,
+                inline_message_id=inline_message_id,
+            )
 
     def as_result(self, context: DelinkifyContext) -> InlineQueryResult:
         if self.is_materialized:
@@ -162,6 +310,7 @@ class Media:
                 id=self.result_id,
                 title=self.caption[:140],
                 description='Some media that can be delinkified',
+                thumbnail_url=self.thumbnail_url,
                 input_message_content=InputTextMessageContent(
                     '⏳ Delinkifying!',
                     link_preview_options=LinkPreviewOptions(is_disabled=True),
@@ -173,9 +322,11 @@ class Media:
         return {
             'source': str(self.source),
             'caption': self.caption,
+            'thumbnail_url': self.thumbnail_url,
             'file_id': self.file_id,
             'url': self.url,
             'result_id': self.result_id,
+            'digest': self.digest,
         }
 
     @classmethod
@@ -183,8 +334,10 @@ class Media:
         m = cls(
             source=Path(data['source']),
             caption=data['caption'],
+            thumbnail_url=data.get('thumbnail_url'),
         )
         m.file_id = data['file_id']
         m.url = data['url']
         m.result_id = data['result_id']
+        m.digest = data.get('digest')
         return m
@@ -1,2 +1,9 @@
-from delinkify.util.util import gdl as gdl
+from delinkify.util.util import gdl_probe as gdl_probe
+from delinkify.util.util import gdl_run as gdl_run
 from delinkify.util.util import get_cookie_file_path as get_cookie_file_path
+from delinkify.util.util import log_throughput as log_throughput
+from delinkify.util.util import ydl_download as ydl_download
+from delinkify.util.util import ydl_download_info as ydl_download_info
+from delinkify.util.util import ydl_download_streams as ydl_download_streams
+from delinkify.util.util import ydl_pipe_command as ydl_pipe_command
+from delinkify.util.util import ydl_probe as ydl_probe
@@ -1,85 +1,222 @@
 from __future__ import annotations
 
-import atexit
-import json
-import threading
-from pathlib import Path
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict
+from collections.abc import Callable
 
 from loguru import logger
 
 from delinkify.media.media import Media, MediaCollection
+from delinkify.util.cache_backend import CacheBackend
+from delinkify.util.metrics import cache_lookups
 
 
 class Cache:
-    def __init__(self, path: Path, save_interval: int):
-        self._path = path / 'cache.json'
+    """In-memory view over a persistent `CacheBackend`.
+
+    Collections are stored under the key `key_fn` derives from their url, so equivalent links
+    share one entry. They are loaded lazily from the backend on first access and kept in memory
+    in LRU order, up to `max_entries`. Changes are tracked per key and only the modified
+    collections are flushed every `save_interval` seconds.
+    """
+
+    # how stale `accessed_at` may get before a read marks the collection as modified
+    TOUCH_RESOLUTION = 60
+
+    def __init__(
+        self,
+        backend: CacheBackend,
+        save_interval: int,
+        max_entries: int,
+        key_fn: Callable[[str], str] = lambda url: url,
+    ):
+        self._backend = backend
         self._save_interval = save_interval
+        self._max_entries = max_entries
+        self._key_fn = key_fn
+        self._cache: OrderedDict[str, MediaCollection] = OrderedDict()
         self._by_result_id: dict[str, Media] = {}
-        self._cache: dict[str, MediaCollection] = self._load()
-        self._modified = False
-        self._timer: threading.Timer | None = None
-
-        self._schedule_save()
-        atexit.register(self._shutdown)
+        self._by_digest: dict[str, Media] = {}
+        self._dirty: set[str] = set()
+        self._writing: set[str] = set()  # taken out of `_dirty` by a flush that has not finished yet
+        self._task: asyncio.Task | None = None
 
     def __contains__(self, url: str) -> bool:
-        return url in self._cache
+        return self.get_by_url(url) is not None
 
     def set(self, url: str, mc: MediaCollection) -> None:
-        logger.trace(f'setting cache for {url} with {len(mc)} media')
-        self._cache[url] = mc
-        for m in mc.media.values():
-            self._by_result_id[m.result_id] = m
-        self._modified = True
-
-    def mark_modified(self) -> None:
-        self._modified = True
+        key = self._key_fn(url)
+        logger.trace(f'setting cache for {key} with {len(mc)} media')
+        previous = self._cache.get(key)
+        if previous is not None and previous is not mc:
+            self._forget(key)  # replaced by another handler's collection, drop the old media from the index
+        self._dirty.add(key)
+        self._remember(key, mc)
+
+    def mark_modified(self, m: Media) -> None:
+        assert m.url is not None
+        key = self._key_fn(m.url)
+        mc = self._get(key)
+        if mc is None:
+            logger.warning(f'media {m.result_id} modified but its collection is no longer cached')
+            return
+        # the collection may have been evicted and reloaded while `m` was in use, put it back
+        mc.media[m.result_id] = m
+        self._index(m)
+        self._dirty.add(key)
 
     def get_by_url(self, url: str) -> MediaCollection | None:
-        mc = self._cache.get(url)
+        mc = self._get(self._key_fn(url))
+        cache_lookups.inc(by='url', result='hit' if mc else 'miss')
         logger.trace(f'cache get by url {"HIT" if mc else "MISS"}: {mc or url}')
         return mc
 
     def get_by_result_id(self, result_id: str) -> Media | None:
         m = self._by_result_id.get(result_id)
+        key = self._key_fn(m.url) if m and m.url else self._backend.key_for_result_id(result_id)
+        mc = self._get(key) if key else None
+        if mc is not None:
+            m = mc.media.get(result_id)
+        cache_lookups.inc(by='result_id', result='hit' if m else 'miss')
         logger.trace(f'cache get by result_id {"HIT" if m else "MISS"}: {m or result_id}')
         return m
 
-    def _load(self) -> dict[str, MediaCollection]:
-        try:
-            with self._path.open() as f:
-                data = json.load(f)
-        except FileNotFoundError, json.JSONDecodeError:
-            logger.warning(f'cache {self._path} not found or invalid, starting empty')
-            return {}
-
-        cache = {url: MediaCollection.from_dict(mc_data) for url, mc_data in data.items()}
-        for mc in cache.values():
-            for m in mc.media.values():
-                self._by_result_id[m.result_id] = m
-
-        total = sum(len(mc) for mc in cache.values())
-        logger.info(f'loaded cache: {total} media entries across {len(cache)} urls')
-        return cache
-
-    def _save(self) -> None:
-        if not self._modified:
+    def get_by_digest(self, digest: str) -> Media | None:
+        """Return a media whose file has the given digest, preferring one that is already materialized."""
+        m = self._by_digest.get(digest)
+        if m is None or not m.is_materialized:
+            found = self._backend.key_for_digest(digest)
+            mc = self._get(found[0]) if found else None
+            other = mc.media.get(found[1]) if mc and found else None
+            if other is not None and (m is None or other.is_materialized):
+                m = other
+        logger.trace(f'cache get by digest {"HIT" if m else "MISS"}: {m or digest}')
+        return m
+
+    async def drop(self, keys: list[str]) -> None:
+        """Remove collections from memory and from the backend."""
+        for key in keys:
+            self._forget(key)
+            self._dirty.discard(key)
+            self._writing.discard(key)
+        await asyncio.to_thread(self._backend.delete, keys)
+
+    def entries(self) -> list[tuple[str, dict]]:
+        return self._backend.entries()
+
+    async def rekey(self) -> None:
+        """Move entries stored under outdated keys (e.g. raw urls) to their current key.
+
+        When several entries map to the same key the first one wins, the others are dropped.
+        """
+        await self.flush()
+        entries = await asyncio.to_thread(self._backend.entries)
+        keys = {key for key, _ in entries}
+        moved: dict[str, dict] = {}
+        stale: list[str] = []
+        for key, mc_data in entries:
+            new_key = self._key_fn(mc_data['url'])
+            if new_key == key:
+                continue
+            stale.append(key)
+            if new_key not in keys and new_key not in moved:
+                moved[new_key] = mc_data
+        if not stale:
             return
-        self._path.parent.mkdir(parents=True, exist_ok=True)
-        serializable = {url: mc.to_dict() for url, mc in self._cache.items()}
-        with self._path.open('w') as f:
-            json.dump(serializable, f, indent=2)
-        self._modified = False
-        logger.info(f'saved cache: {len(self._cache)} entries')
-
-    def _schedule_save(self) -> None:
-        self._save()
-        self._timer = threading.Timer(self._save_interval, self._schedule_save)
-        self._timer.daemon = True
-        self._timer.start()
-
-    def _shutdown(self) -> None:
+
+        for key in stale:
+            self._forget(key)
+        await asyncio.to_thread(self._backend.write, list(moved.items()))
+        await asyncio.to_thread(self._backend.delete, stale)
+        logger.info(f're-keyed {len(moved)} cache entries, dropped {len(stale) - len(moved)} duplicates')
+
+    def _get(self, key: str) -> MediaCollection | None:
+        mc = self._cache.get(key)
+        if mc is None:
+            mc = self._backend.get(key)
+            if mc is not None:
+                self._remember(key, mc)
+        else:
+            self._cache.move_to_end(key)
+        if mc is not None:
+            self._touch(key, mc)
+        return mc
+
+    def _touch(self, key: str, mc: MediaCollection) -> None:
+        now = time.time()
+        if now - mc.accessed_at > self.TOUCH_RESOLUTION:
+            mc.accessed_at = now
+            self._dirty.add(key)
+
+    def _remember(self, key: str, mc: MediaCollection) -> None:
+        self._cache[key] = mc
+        self._cache.move_to_end(key)
+        for m in mc.media.values():
+            self._index(m)
+        self._evict()
+
+    def _index(self, m: Media) -> None:
+        self._by_result_id[m.result_id] = m
+        if m.digest is None:
+            return
+        current = self._by_digest.get(m.digest)
+        if current is None or m.is_materialized or not current.is_materialized:
+            self._by_digest[m.digest] = m
+
+    def _forget(self, key: str) -> None:
+        mc = self._cache.pop(key, None)
+        for m in mc.media.values() if mc else []:
+            self._by_result_id.pop(m.result_id, None)
+            if m.digest is not None and self._by_digest.get(m.digest) is m:
+                del self._by_digest[m.digest]
+
+    def _evict(self) -> None:
+        # dirty collections stay in memory until flushed, they are evicted on a later pass
+        excess = len(self._cache) - self._max_entries
+        if excess <= 0:
+            return
+        unsaved = self._dirty | self._writing
+        evictable = [key for key in self._cache if key not in unsaved][:excess]
+        for key in evictable:
+            self._forget(key)
+        logger.trace(f'evicted {len(evictable)} entries from memory')
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        keys = list(self._dirty)
+        self._dirty.clear()
+        self._writing.update(keys)
+        # serialize on the event loop so the writer thread never sees collections being mutated
+        rows = [(key, self._cache[key].to_dict()) for key in keys]
+        try:
+            await asyncio.to_thread(self._backend.write, rows)
+        except Exception:
+            self._dirty.update(keys)
+            raise
+        finally:
+            self._writing.difference_update(keys)
+        logger.info(f'saved cache: {len(rows)} modified entries')
+        self._evict()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._save_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.opt(exception=e).error('cache flush failed')
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
         logger.info('cache shutdown')
-        if self._timer is not None:
-            self._timer.cancel()
-        self._save()
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        await self.flush()
+        self._backend.close()
@@ -0,0 +1,289 @@
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from loguru import logger
+
+from delinkify.media.media import MediaCollection
+
+
+class CacheBackend(ABC):
+    """Persistent storage behind `Cache`.
+
+    Backends store serialized collections (`MediaCollection.to_dict`) under a cache key.
+    Lookups happen on the event loop and must be cheap, writes run in a worker thread.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> MediaCollection | None: ...
+
+    @abstractmethod
+    def key_for_result_id(self, result_id: str) -> str | None: ...
+
+    @abstractmethod
+    def key_for_digest(self, digest: str) -> tuple[str, str] | None:
+        """`(key, result_id)` of a media with the given file digest, materialized ones first."""
+
+    @abstractmethod
+    def write(self, rows: list[tuple[str, dict]]) -> None:
+        """Atomically upsert the given `(key, serialized collection)` rows."""
+
+    @abstractmethod
+    def delete(self, keys: list[str]) -> None: ...
+
+    @abstractmethod
+    def entries(self) -> list[tuple[str, dict]]:
+        """Snapshot of every stored `(key, serialized collection)`, used by the janitor."""
+
+    @abstractmethod
+    def close(self) -> None: ...
+
+
+class JSONBackend(CacheBackend):
+    """The original whole-file JSON cache. Every write rewrites the full file."""
+
+    def __init__(self, path: Path):
+        self._path = path / 'cache.json'
+        self._lock = threading.Lock()
+        self._data: dict[str, dict] = {}
+        self._by_result_id: dict[str, str] = {}
+        self._by_digest: dict[str, tuple[str, str]] = {}
+
+        try:
+            with self._path.open() as f:
+                self._data = json.load(f)
+        except FileNotFoundError, json.JSONDecodeError:
+            logger.warning(f'cache {self._path} not found or invalid, starting empty')
+
+        for key, mc_data in self._data.items():
+            self._index(key, mc_data)
+        logger.info(f'loaded json cache: {len(self._by_result_id)} media entries across {len(self._data)} urls')
+
+    def get(self, key: str) -> MediaCollection | None:
+        mc_data = self._data.get(key)
+        return MediaCollection.from_dict(mc_data) if mc_data else None
+
+    def key_for_result_id(self, result_id: str) -> str | None:
+        return self._by_result_id.get(result_id)
+
+    def key_for_digest(self, digest: str) -> tuple[str, str] | None:
+        return self._by_digest.get(digest)
+
+    def _index(self, key: str, mc_data: dict) -> None:
+        for result_id, m in mc_data['media'].items():
+            self._by_result_id[result_id] = key
+            digest = m.get('digest')
+            if digest is None:
+                continue
+            current = self._by_digest.get(digest)
+            other = self._data.get(current[0], {}).get('media', {}).get(current[1]) if current else None
+            if other is None or m['file_id'] or not other['file_id']:
+                self._by_digest[digest] = (key, result_id)
+
+    def write(self, rows: list[tuple[str, dict]]) -> None:
+        with self._lock:
+            for key, mc_data in rows:
+                self._data[key] = mc_data
+                self._index(key, mc_data)
+            self._dump()
+
+    def delete(self, keys: list[str]) -> None:
+        with self._lock:
+            for key in keys:
+                mc_data = self._data.pop(key, None)
+                for result_id in mc_data['media'] if mc_data else []:
+                    if self._by_result_id.get(result_id) == key:
+                        del self._by_result_id[result_id]
+                self._by_digest = {d: found for d, found in self._by_digest.items() if found[0] != key}
+            self._dump()
+
+    def entries(self) -> list[tuple[str, dict]]:
+        with self._lock:
+            return list(self._data.items())
+
+    def _dump(self) -> None:
+        tmp_path = self._path.with_suffix('.json.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(self._data, f, indent=2)
+        tmp_path.replace(self._path)
+
+    def close(self) -> None:
+        pass
+
+
+# each entry upgrades the schema by one version, tracked in `PRAGMA user_version`
+MIGRATIONS = [
+    """
+    CREATE TABLE collections (
+        key TEXT PRIMARY KEY,
+        url TEXT NOT NULL
+    );
+    CREATE TABLE media (
+        result_id TEXT PRIMARY KEY,
+        key TEXT NOT NULL REFERENCES collections(key) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        source TEXT NOT NULL,
+        caption TEXT NOT NULL,
+        file_id TEXT,
+        url TEXT
+    );
+    CREATE INDEX media_key ON media(key);
+    """,
+    """
+    ALTER TABLE collections ADD COLUMN created_at REAL NOT NULL DEFAULT 0;
+    ALTER TABLE collections ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0;
+    UPDATE collections SET created_at = unixepoch('now'), accessed_at = unixepoch('now');
+    """,
+    """
+    ALTER TABLE collections ADD COLUMN handler TEXT;
+    ALTER TABLE media ADD COLUMN thumbnail_url TEXT;
+    """,
+    """
+    ALTER TABLE media ADD COLUMN digest TEXT;
+    CREATE INDEX media_digest ON media(digest);
+    """,
+    """
+    ALTER TABLE collections ADD COLUMN media_dir TEXT;
+    """,
+]
+
+
+class SQLiteBackend(CacheBackend):
+    """SQLite cache in WAL mode. Only the collections that changed are written.
+
+    Lookups on the event loop use a connection of their own, so they only ever see committed
+    writes and never wait for the writer thread.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path / 'cache.sqlite3'
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA foreign_keys=ON')
+
+        version = self._migrate()
+        if version == 0:
+            self._import_json(path / 'cache.json')
+
+        self._reader = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._reader.row_factory = sqlite3.Row
+        count = self._reader.execute('SELECT COUNT(*) FROM collections').fetchone()[0]
+        logger.info(f'opened sqlite cache {self._path} with {count} urls')
+
+    def _migrate(self) -> int:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f'migrating cache schema to version {i}')
+            with self._lock:
+                self._db.executescript(f'BEGIN; {migration}; PRAGMA user_version = {i}; COMMIT;')
+        return version
+
+    def _import_json(self, json_path: Path) -> None:
+        try:
+            with json_path.open() as f:
+                data = json.load(f)
+        except FileNotFoundError, json.JSONDecodeError:
+            return
+        logger.info(f'migrating {len(data)} urls from {json_path}')
+        self.write(list(data.items()))
+        json_path.rename(json_path.with_suffix('.json.migrated'))
+
+    def get(self, key: str) -> MediaCollection | None:
+        # one read transaction, so the collection and its media come from the same write
+        self._reader.execute('BEGIN')
+        try:
+            row = self._reader.execute('SELECT * FROM collections WHERE key = ?', (key,)).fetchone()
+            media = self._reader.execute('SELECT * FROM media WHERE key = ? ORDER BY position', (key,)).fetchall()
+        finally:
+            self._reader.execute('COMMIT')
+        return MediaCollection.from_dict(self._row_to_dict(row, media)) if row is not None else None
+
+    def _row_to_dict(self, row: sqlite3.Row, media: list[sqlite3.Row]) -> dict:
+        return dict(row) | {'media': {m['result_id']: dict(m) for m in media}}
+
+    def key_for_result_id(self, result_id: str) -> str | None:
+        row = self._reader.execute('SELECT key FROM media WHERE result_id = ?', (result_id,)).fetchone()
+        return row['key'] if row else None
+
+    def key_for_digest(self, digest: str) -> tuple[str, str] | None:
+        row = self._reader.execute(
+            'SELECT key, result_id FROM media WHERE digest = ? ORDER BY file_id IS NULL LIMIT 1',
+            (digest,),
+        ).fetchone()
+        return (row['key'], row['result_id']) if row else None
+
+    def write(self, rows: list[tuple[str, dict]]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                for key, mc_data in rows:
+                    self._db.execute(
+                        """
+                        INSERT INTO collections (key, url, handler, media_dir, created_at, accessed_at)
+                        VALUES (:key, :url, :handler, :media_dir, :created_at, :accessed_at)
+                        ON CONFLICT(key) DO UPDATE SET
+                            url = excluded.url, handler = excluded.handler, media_dir = excluded.media_dir,
+                            created_at = excluded.created_at, accessed_at = excluded.accessed_at
+                        """,
+                        {'handler': None, 'media_dir': None, 'created_at': now, 'accessed_at': now}
+                        | mc_data
+                        | {'key': key},
+                    )
+                    # the collection may have been replaced by one with other media
+                    self._db.execute('DELETE FROM media WHERE key = ?', (key,))
+                    self._db.executemany(
+                        """
+                        INSERT INTO media (
+                            result_id, key, position, source, caption, thumbnail_url, file_id, url, digest
+                        )
+                        VALUES (
+                            :result_id, :key, :position, :source, :caption, :thumbnail_url, :file_id, :url, :digest
+                        )
+                        ON CONFLICT(result_id) DO UPDATE SET
+                            key = excluded.key, position = excluded.position, source = excluded.source,
+                            caption = excluded.caption, thumbnail_url = excluded.thumbnail_url,
+                            file_id = excluded.file_id, url = excluded.url, digest = excluded.digest
+                        """,
+                        [
+                            {'thumbnail_url': None, 'digest': None} | m | {'key': key, 'position': i}
+                            for i, m in enumerate(mc_data['media'].values())
+                        ],
+                    )
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def delete(self, keys: list[str]) -> None:
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('DELETE FROM collections WHERE key = ?', [(k,) for k in keys])
+            self._db.execute('COMMIT')
+
+    def entries(self) -> list[tuple[str, dict]]:
+        with self._lock:
+            collections = self._db.execute('SELECT * FROM collections').fetchall()
+            media: dict[str, list[sqlite3.Row]] = {}
+            for m in self._db.execute('SELECT * FROM media ORDER BY key, position'):
+                media.setdefault(m['key'], []).append(m)
+        return [(row['key'], self._row_to_dict(row, media.get(row['key'], []))) for row in collections]
+
+    def close(self) -> None:
+        self._reader.close()
+        with self._lock:
+            self._db.close()
+
+
+def make_backend(kind: str, path: Path) -> CacheBackend:
+    if kind == 'sqlite':
+        return SQLiteBackend(path)
+    if kind == 'json':
+        return JSONBackend(path)
+    raise ValueError(f'unknown cache backend: {kind}')
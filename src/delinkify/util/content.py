@@ -0,0 +1,45 @@
+import hashlib
+from pathlib import Path
+
+from loguru import logger
+
+DIGEST_SIZE = 16
+
+
+def file_digest(path: Path) -> str:
+    """Hash the bytes of `path`, equal digests mean equal files no matter the url they came from."""
+    with path.open('rb') as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=DIGEST_SIZE)).hexdigest()
+
+
+def total_size(paths: list[Path]) -> int:
+    return sum(p.stat().st_size for p in paths if p.exists())
+
+
+def link_duplicate(path: Path, original: Path) -> bool:
+    """Replace `path` with a hard link to `original`, which must hold the same bytes.
+
+    Returns whether the link was made. Nothing is done when either file is gone, they are already
+    the same inode, their sizes differ (`original` was shrunk in place) or they live on different
+    filesystems.
+    """
+    try:
+        stat, original_stat = path.stat(), original.stat()
+    except FileNotFoundError:
+        return False
+    if (stat.st_dev, stat.st_ino) == (original_stat.st_dev, original_stat.st_ino):
+        return False
+    if stat.st_size != original_stat.st_size or stat.st_dev != original_stat.st_dev:
+        return False
+
+    tmp_path = path.with_name(f'{path.name}.link')
+    try:
+        tmp_path.unlink(missing_ok=True)
+        tmp_path.hardlink_to(original)
+        tmp_path.replace(path)
+    except OSError as e:
+        logger.warning(f'could not hard link {path} to {original}: {e}')
+        tmp_path.unlink(missing_ok=True)
+        return False
+    logger.info(f'{path} duplicates {original}, linked it to save {stat.st_size / (1024 * 1024):.2f}mb')
+    return True
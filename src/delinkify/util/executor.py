@@ -0,0 +1,96 @@
+import asyncio
+import atexit
+import contextlib
+import functools
+from collections import defaultdict
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, TypeVar
+
+from loguru import logger
+
+T = TypeVar('T')
+
+
+@dataclass
+class HandlerStats:
+    queued: int = 0
+    running: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class DownloadExecutor:
+    """Runs blocking extractor calls (yt-dlp, gallery-dl) off the event loop.
+
+    Concurrency is bounded globally by the pool size and per handler by a semaphore, so
+    a slow handler can only ever take up its own share of the pool. A cancelled `run` only
+    returns once the call it started has ended.
+    """
+
+    def __init__(self, kind: str, max_workers: int, per_handler_limit: int):
+        if kind == 'thread':
+            self._pool: Executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='delinkify-dl')
+        elif kind == 'process':
+            self._pool = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            raise ValueError(f'unknown executor kind: {kind}')
+        self.kind = kind
+        self.max_workers = max_workers
+        self.per_handler_limit = per_handler_limit
+        self.stats: dict[str, HandlerStats] = defaultdict(HandlerStats)
+        self._global = asyncio.Semaphore(max_workers)
+        self._per_handler: dict[str, asyncio.Semaphore] = {}
+
+        logger.info(f'download executor: {kind} pool, {max_workers} workers, {per_handler_limit} per handler')
+        atexit.register(self._shutdown)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(s.queued for s in self.stats.values())
+
+    @property
+    def running(self) -> int:
+        return sum(s.running for s in self.stats.values())
+
+    async def run(self, handler: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run `fn` in the pool on behalf of `handler`, waiting for a free slot if needed.
+
+        In process mode `fn` and its arguments must be picklable, so pass module-level
+        functions rather than bound methods.
+        """
+        stats = self.stats[handler]
+        semaphore = self._per_handler.setdefault(handler, asyncio.Semaphore(self.per_handler_limit))
+
+        stats.queued += 1
+        started = False
+        logger.trace(f'queued {fn.__name__} for {handler}, queue depth {self.queue_depth}, running {self.running}')
+        try:
+            async with semaphore, self._global:
+                stats.queued -= 1
+                stats.running += 1
+                started = True
+                future = asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+                try:
+                    result = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # the call cannot be interrupted, it keeps its slots until it is over
+                    with contextlib.suppress(Exception):
+                        await future
+                    raise
+                except Exception:
+                    stats.failed += 1
+                    raise
+                finally:
+                    stats.running -= 1
+        finally:
+            if not started:
+                stats.queued -= 1
+
+        stats.completed += 1
+        return result
+
+    def _shutdown(self) -> None:
+        logger.info('download executor shutdown')
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,57 @@
+import contextlib
+import threading
+from collections import defaultdict
+from collections.abc import Callable, Generator
+
+from loguru import logger
+
+MAX_IDLE = 4  # idle instances kept per handler
+
+
+class ExtractorPool[T]:
+    """Warm extractor instances (`YoutubeDL`s, gallery-dl sessions) kept per handler between requests.
+
+    An instance is checked out by one request at a time, so calls for the same handler can run
+    concurrently without sharing state. Instances whose request failed are closed rather than
+    returned, in case they were left half way through something. Each process has its own pools.
+    """
+
+    def __init__(self, name: str, close: Callable[[T], None]):
+        self.name = name
+        self._close = close
+        self._lock = threading.Lock()
+        self._idle: dict[str, list[T]] = defaultdict(list)
+        self.created = 0
+        self.reused = 0
+
+    @contextlib.contextmanager
+    def checkout(self, key: str, create: Callable[[], T]) -> Generator[T]:
+        with self._lock:
+            idle = self._idle[key]
+            instance = idle.pop() if idle else None
+            if instance is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        if instance is None:
+            logger.debug(f'creating {self.name} instance for {key}')
+            instance = create()
+
+        try:
+            yield instance
+        except BaseException:
+            self._close(instance)
+            raise
+
+        with self._lock:
+            if len(self._idle[key]) < MAX_IDLE:
+                self._idle[key].append(instance)
+                return
+        self._close(instance)
+
+    def close(self) -> None:
+        with self._lock:
+            instances = [i for idle in self._idle.values() for i in idle]
+            self._idle.clear()
+        for instance in instances:
+            self._close(instance)
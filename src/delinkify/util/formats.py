@@ -0,0 +1,164 @@
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import Any
+
+from loguru import logger
+
+from delinkify.util.video import MAX_VIDEO_SIZE_MB, RESOLUTION_LADDER, UNKNOWN_AUDIO_KBPS, VideoInfo
+
+# downloads are aborted past this size, anything bigger would not survive the transcode anyway
+MAX_DOWNLOAD_MB = MAX_VIDEO_SIZE_MB * 2
+
+MP4_VIDEO_EXTS = {'mp4'}
+MP4_AUDIO_EXTS = {'m4a', 'mp4'}
+
+# protocols ffmpeg can read on its own when transcoding straight from the source
+STREAMABLE_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native'}
+
+
+def is_avc(codec: str | None) -> bool:
+    return codec is not None and codec.startswith(('avc', 'h264'))
+
+
+def is_aac(codec: str | None) -> bool:
+    return codec is not None and codec.startswith(('mp4a', 'aac'))
+
+
+@dataclass
+class Candidate:
+    video: dict[str, Any]
+    audio: dict[str, Any] | None = None  # None for progressive formats, which carry their own audio
+
+    @property
+    def size(self) -> int | None:
+        sizes = [f.get('filesize') or f.get('filesize_approx') for f in (self.video, self.audio) if f]
+        return sum(sizes) if all(sizes) else None
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio is not None or self.video.get('acodec') != 'none'
+
+    @property
+    def is_playable(self) -> bool:
+        """Whether telegram can play the result inline without a transcode: h264 and aac in an mp4."""
+        if self.audio is None:
+            return (
+                self.video.get('ext') in MP4_VIDEO_EXTS
+                and is_avc(self.video.get('vcodec'))
+                and (is_aac(self.video.get('acodec')) or self.video.get('acodec') == 'none')
+            )
+        return (
+            self.video.get('ext') in MP4_VIDEO_EXTS
+            and self.audio.get('ext') in MP4_AUDIO_EXTS
+            and is_avc(self.video.get('vcodec'))
+            and is_aac(self.audio.get('acodec'))
+        )
+
+    @property
+    def height(self) -> int:
+        return self.video.get('height') or 0
+
+    @property
+    def tbr(self) -> float:
+        return sum(f.get('tbr') or 0 for f in (self.video, self.audio) if f)
+
+    def as_format(self, merge_ext: str = 'mp4') -> dict[str, Any]:
+        if self.audio is None:
+            return self.video
+        v, a = self.video, self.audio
+        return {
+            'format_id': f'{v["format_id"]}+{a["format_id"]}',
+            'ext': merge_ext,  # whatever the codecs, the streams are merged into `merge_output_format`
+            'requested_formats': [v, a],
+            'protocol': f'{v["protocol"]}+{a["protocol"]}',
+        }
+
+    def __str__(self) -> str:
+        size = f'{self.size / (1024 * 1024):.1f}mb' if self.size else 'unknown size'
+        codecs = f'{self.video.get("vcodec")}/{(self.audio or self.video).get("acodec")}'
+        return f'{self.as_format()["format_id"]} ({self.height}p {codecs}, {size})'
+
+
+class FormatSelector:
+    """yt-dlp `format` callable that picks the rendition that can be sent without transcoding.
+
+    Formats that fit `max_bytes` win, then those of unknown size, then the rest. Within each
+    group formats with audio come first, then h264/aac mp4 so the file goes out untouched, and
+    finally quality. When nothing fits, the smallest rendition at the highest resolution the
+    transcoder would keep is picked, so the transcode downloads as little as possible.
+    """
+
+    def __init__(self, max_bytes: int = MAX_VIDEO_SIZE_MB * 1024 * 1024, merge_ext: str = 'mp4'):
+        self.max_bytes = max_bytes
+        self.merge_ext = merge_ext
+
+    def candidates(self, formats: list[dict[str, Any]]) -> list[Candidate]:
+        videos = [f for f in formats if f.get('vcodec') != 'none']
+        audios = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+        progressive = [Candidate(f) for f in videos]
+        merged = [Candidate(v, a) for v in videos if v.get('acodec') == 'none' for a in audios]
+        return progressive + merged
+
+    def rank(self, c: Candidate) -> tuple:
+        size = c.size
+        if size is not None and size <= self.max_bytes:
+            return (2, c.has_audio, c.is_playable, c.height, c.tbr)
+        if size is None:
+            return (1, c.has_audio, c.is_playable, c.height, c.tbr)
+        # over budget: it will be transcoded, so only resolution up to the top of the ladder counts
+        return (0, c.has_audio, min(c.height, RESOLUTION_LADDER[0][0]), -size)
+
+    def __call__(self, ctx: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        candidates = self.candidates(ctx['formats'])
+        if not candidates:  # audio only, nothing to choose from
+            yield from ctx['formats'][-1:]
+            return
+        best = max(candidates, key=self.rank)
+        if self.rank(best)[0] == 0:
+            logger.info(f'no format fits {self.max_bytes // (1024 * 1024)}mb, picked {best} for transcoding')
+        else:
+            logger.debug(f'picked format {best} out of {len(candidates)} candidates')
+        yield best.as_format(self.merge_ext)
+
+
+def video_info(info: dict[str, Any]) -> VideoInfo | None:
+    """Describe the format yt-dlp selected for `info` the way ffprobe would, None if it cannot tell."""
+    duration = info.get('duration')
+    if not duration:
+        return None
+    formats = info.get('requested_formats') or [info]
+    video = next((f for f in formats if f.get('vcodec') != 'none'), None)
+    audio = next((f for f in formats if f.get('acodec') != 'none'), None)
+    if video is None:
+        return None
+
+    size = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats)
+    tbr = sum(f.get('tbr') or 0 for f in formats)
+    size = size or int(tbr * 1000 / 8 * duration)
+    if not size:
+        return None
+    abr = (audio.get('abr') or UNKNOWN_AUDIO_KBPS) if audio else 0
+    vbr = video.get('vbr') or max(int(size * 8 / 1000 / duration) - abr, 0)
+
+    vcodec, acodec = video.get('vcodec'), audio.get('acodec') if audio else None
+    return VideoInfo(
+        size=size,
+        duration=float(duration),
+        format_names={info.get('ext') or ''},
+        vcodec='h264' if is_avc(vcodec) else vcodec,
+        acodec='aac' if is_aac(acodec) else acodec,
+        width=video.get('width') or 0,
+        height=video.get('height') or 0,
+        video_kbps=int(vbr),
+        audio_kbps=int(abr),
+        extra_streams=0,
+        faststart=False,  # unknown until downloaded
+    )
+
+
+def stream_urls(info: dict[str, Any]) -> list[tuple[str, dict[str, str]]] | None:
+    """Return the (url, headers) pairs ffmpeg needs to read the selected format, None if it cannot."""
+    formats = info.get('requested_formats') or [info]
+    if not all(f.get('protocol') in STREAMABLE_PROTOCOLS and f.get('url') for f in formats):
+        return None
+    return [(f['url'], f.get('http_headers') or {}) for f in formats]
@@ -0,0 +1,157 @@
+import asyncio
+import contextlib
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from http import HTTPStatus
+
+from loguru import logger
+
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 60  # seconds a keep-alive connection may sit without a request
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    headers: dict[str, str]  # lowercase names
+    body: bytes
+
+
+@dataclass
+class Response:
+    status: HTTPStatus = HTTPStatus.OK
+    body: bytes = b''
+    content_type: str = 'text/plain; charset=utf-8'
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+type Route = Callable[[Request], Awaitable[Response]]
+
+
+class BadRequestError(Exception):
+    def __init__(self, status: HTTPStatus):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+class HTTPServer:
+    """Small HTTP/1.1 server on asyncio streams, for local endpoints like the metrics.
+
+    It understands exactly what a scraper sends: requests with a Content-Length body (no chunked
+    encoding), on keep-alive connections. Routes match method and path exactly.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes: dict[tuple[str, str], Route] = {}
+        self._server: asyncio.Server | None = None
+        self._connections: set[asyncio.Task] = set()
+
+    def route(self, method: str, path: str, handler: Route) -> None:
+        self._routes[method, path] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        # port 0 picks a free port, report the actual one
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(
+            f'http server listening on {self.host}:{self.port}, routes: {", ".join(p for _, p in self._routes)}'
+        )
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await self._server.wait_closed()
+        logger.info('http server stopped')
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self._connections.add(task)
+        try:
+            await self._serve_requests(reader, writer)
+        except TimeoutError, ConnectionError, asyncio.IncompleteReadError:
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _serve_requests(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            try:
+                request = await asyncio.wait_for(self._read(reader), IDLE_TIMEOUT)
+            except BadRequestError as e:
+                await self._write(writer, Response(e.status, e.status.phrase.encode()), keep_alive=False)
+                return
+            if request is None:
+                return
+            keep_alive = request.headers.get('connection', '').lower() != 'close'
+            await self._write(writer, await self._dispatch(request), keep_alive)
+            if not keep_alive:
+                return
+
+    async def _readline(self, reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readline()
+        except asyncio.LimitOverrunError, ValueError:
+            # a line over the stream limit (64 KiB), what is left of the request cannot be framed
+            raise BadRequestError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    async def _read(self, reader: asyncio.StreamReader) -> Request | None:
+        line = await self._readline(reader)
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise BadRequestError(HTTPStatus.BAD_REQUEST)
+
+        headers: dict[str, str] = {}
+        while (line := await self._readline(reader)) not in {b'\r\n', b'\n', b''}:
+            if len(headers) >= MAX_HEADERS:
+                raise BadRequestError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            raise BadRequestError(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            raise BadRequestError(HTTPStatus.BAD_REQUEST)
+        if length > MAX_BODY_SIZE:
+            raise BadRequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b''
+        return Request(method, target.split('?', 1)[0], headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        route = self._routes.get((request.method, request.path))
+        if route is None:
+            status = HTTPStatus.NOT_FOUND
+            if any(path == request.path for _, path in self._routes):
+                status = HTTPStatus.METHOD_NOT_ALLOWED
+            return Response(status, status.phrase.encode())
+        try:
+            return await route(request)
+        except Exception as e:
+            logger.opt(exception=e).error(f'http handler for {request.method} {request.path} failed')
+            return Response(HTTPStatus.INTERNAL_SERVER_ERROR, b'Internal Server Error')
+
+    async def _write(self, writer: asyncio.StreamWriter, response: Response, keep_alive: bool) -> None:
+        headers = {
+            'Content-Type': response.content_type,
+            'Content-Length': str(len(response.body)),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+        } | response.headers
+        head = f'HTTP/1.1 {response.status.value} {response.status.phrase}\r\n'
+        head += ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b'\r\n' + response.body)
+        await writer.drain()
@@ -0,0 +1,181 @@
+import asyncio
+import contextlib
+import glob
+import shutil
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+
+from delinkify.media.media import MediaCollection
+from delinkify.util.cache import Cache
+from delinkify.util.singleflight import SingleFlight
+
+# files yt-dlp, gallery-dl, ffmpeg (`<stem>.part.mp4`) and the deduplication write before moving them into place
+PARTIAL_PATTERNS = ['*.part', '*.part.*', '*.part-Frag*', '*.ytdl', '*.temp.*', '*.link']
+
+
+def disk_usage(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    # duplicates are hard links to the same inode, count them once
+    inodes = {(s.st_dev, s.st_ino): s.st_size for s in (f.stat() for f in path.rglob('*') if f.is_file())}
+    return sum(inodes.values())
+
+
+def remove(path: Path) -> int:
+    """Delete a file or directory tree, returning the number of bytes reclaimed."""
+    try:
+        size = disk_usage(path)
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+@dataclass
+class Sweep:
+    drop: list[str] = field(default_factory=list)  # cache keys to remove entirely
+    paths: list[Path] = field(default_factory=list)  # files and directories to delete
+
+
+class Janitor:
+    """Evicts expired cache entries and garbage collects files under the media path.
+
+    Every `interval` seconds it:
+    * drops cache entries not accessed for `ttl` seconds, along with their files.
+    * deletes the local files of materialized media older than `grace`, the file_id is enough.
+    * drops collections older than `grace` that were never chosen, they will be fetched again.
+    * deletes directories older than `grace` that no cache entry references (failed downloads).
+    * drops the least recently accessed collections while the media path exceeds `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache: Cache,
+        materializing: SingleFlight,
+        media_path: Path,
+        interval: int,
+        ttl: int,
+        grace: int,
+        max_bytes: int,
+    ):
+        self._cache = cache
+        self._materializing = materializing
+        self._media_path = media_path
+        self._interval = interval
+        self._ttl = ttl
+        self._grace = grace
+        self._max_bytes = max_bytes
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def remove_partials(self) -> int:
+        """Delete half-written files left behind by work interrupted by a restart."""
+        paths = await asyncio.to_thread(
+            lambda: [p for pattern in PARTIAL_PATTERNS for p in self._media_path.rglob(pattern)]
+        )
+        reclaimed = await asyncio.to_thread(self._delete, paths)
+        if paths:
+            logger.info(f'removed {len(paths)} partial files, reclaimed {reclaimed / (1024 * 1024):.2f}mb')
+        return reclaimed
+
+    async def _run_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.run()
+            except Exception as e:
+                logger.opt(exception=e).error('janitor run failed')
+
+    async def run(self) -> int:
+        await self._cache.flush()
+        entries = await asyncio.to_thread(self._cache.entries)
+        collections = {key: MediaCollection.from_dict(d) for key, d in entries}
+        # collections being downloaded or uploaded are left alone, their directories still count as referenced
+        busy = {
+            key for key, mc in collections.items() if any(result_id in self._materializing for result_id in mc.media)
+        }
+
+        sweep = await asyncio.to_thread(self._plan, collections, busy, time.time())
+        await self._cache.drop(sweep.drop)
+        reclaimed = await asyncio.to_thread(self._delete, sweep.paths)
+
+        over_budget = await asyncio.to_thread(self._plan_budget, collections, busy | set(sweep.drop))
+        await self._cache.drop(over_budget.drop)
+        reclaimed += await asyncio.to_thread(self._delete, over_budget.paths)
+
+        dropped = len(sweep.drop) + len(over_budget.drop)
+        logger.info(f'janitor reclaimed {reclaimed / (1024 * 1024):.2f}mb, dropped {dropped} cache entries')
+        return reclaimed
+
+    def _plan(self, collections: dict[str, MediaCollection], busy: set[str], now: float) -> Sweep:
+        sweep = Sweep()
+        for key, mc in collections.items():
+            if key in busy:
+                continue
+            media_dir = self._media_path / mc.media_dir
+            if now - mc.accessed_at > self._ttl:
+                sweep.drop.append(key)
+                sweep.paths.append(media_dir)
+            elif now - mc.created_at < self._grace:
+                continue
+            elif mc.is_materialized:
+                sweep.paths.append(media_dir)
+            elif not any(m.is_materialized for m in mc.media.values()):
+                sweep.drop.append(key)
+                sweep.paths.append(media_dir)
+            else:
+                for m in mc.media.values():
+                    if m.is_materialized:
+                        sweep.paths.append(m.source)
+                        if m.source.stem.endswith('-shrunk'):
+                            # the shrunk copy is always an mp4, the original may have any extension
+                            original = glob.escape(m.source.stem.removesuffix('-shrunk'))
+                            sweep.paths.extend(m.source.parent.glob(f'{original}.*'))
+
+        referenced = {mc.media_dir for mc in collections.values()}
+        for d in self._media_path.iterdir():
+            if d.name not in referenced and now - d.stat().st_mtime > self._grace:
+                sweep.paths.append(d)
+        return sweep
+
+    def _plan_budget(self, collections: dict[str, MediaCollection], skip: set[str]) -> Sweep:
+        sweep = Sweep()
+        usage = disk_usage(self._media_path)
+        if usage <= self._max_bytes:
+            return sweep
+        logger.warning(f'media path uses {usage} bytes, over the budget of {self._max_bytes} bytes')
+        remaining = sorted(
+            ((k, mc) for k, mc in collections.items() if k not in skip),
+            key=lambda item: item[1].accessed_at,
+        )
+        for key, mc in remaining:
+            if usage <= self._max_bytes:
+                break
+            media_dir = self._media_path / mc.media_dir
+            if not media_dir.exists():
+                continue
+            usage -= disk_usage(media_dir)
+            sweep.paths.append(media_dir)
+            if not mc.is_materialized:
+                sweep.drop.append(key)
+        return sweep
+
+    def _delete(self, paths: list[Path]) -> int:
+        reclaimed = 0
+        for path in paths:
+            reclaimed += remove(path)
+        return reclaimed
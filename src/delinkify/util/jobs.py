@@ -0,0 +1,198 @@
+import asyncio
+import contextlib
+import sqlite3
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from enum import StrEnum
+from pathlib import Path
+
+from loguru import logger
+
+from delinkify.util.negative_cache import PERMANENT_FAILURES, classify
+
+POLL_INTERVAL = 10
+RETRY_BASE_DELAY = 30  # seconds before the first retry, doubled on every attempt
+MAX_ATTEMPTS = 5
+
+
+class JobState(StrEnum):
+    RESOLVE = 'resolve'
+    DOWNLOAD = 'download'
+    TRANSCODE = 'transcode'
+    UPLOAD = 'upload'
+    EDIT_MESSAGE = 'edit_message'
+
+
+@dataclass
+class Job:
+    id: int
+    result_id: str
+    inline_message_id: str
+    url: str
+    position: int  # index of the media in its collection, to find it again if the result_id is gone
+    state: JobState
+    attempts: int
+    created_at: float
+    next_attempt_at: float
+
+
+# each entry upgrades the schema by one version, tracked in `PRAGMA user_version`
+MIGRATIONS = [
+    """
+    CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        result_id TEXT NOT NULL,
+        inline_message_id TEXT NOT NULL UNIQUE,
+        url TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        next_attempt_at REAL NOT NULL
+    );
+    CREATE INDEX jobs_next_attempt_at ON jobs(next_attempt_at);
+    """,
+]
+
+
+class JobQueue:
+    """Durable record of the chosen results still being delivered, in SQLite.
+
+    A job is added when a result is chosen and deleted once its message has been edited, its
+    state tracks how far it got. Jobs that fail are retried with exponential backoff, up to
+    `MAX_ATTEMPTS` times, unless the failure is one retrying cannot fix. Jobs left over by a
+    previous run are resumed on `start`.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path / 'jobs.sqlite3'
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+        self._runner: Callable[[Job], Awaitable[None]] | None = None
+        self._running: set[int] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._task: asyncio.Task | None = None
+        self.closed = False
+        logger.info(f'opened job queue {self._path} with {self.depth} unfinished jobs')
+
+    def _migrate(self) -> None:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f'migrating job queue schema to version {i}')
+            with self._lock:
+                self._db.executescript(f'BEGIN; {migration}; PRAGMA user_version = {i}; COMMIT;')
+
+    @property
+    def depth(self) -> int:
+        return self._db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    @property
+    def oldest_age(self) -> float:
+        """Seconds since the oldest unfinished job was added, 0 if there are none."""
+        oldest = self._db.execute('SELECT MIN(created_at) FROM jobs').fetchone()[0]
+        return time.time() - oldest if oldest is not None else 0
+
+    def add(self, result_id: str, inline_message_id: str, url: str, position: int) -> Job:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                """
+                INSERT INTO jobs (result_id, inline_message_id, url, position, state, created_at, next_attempt_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(inline_message_id) DO UPDATE SET result_id = excluded.result_id
+                RETURNING *
+                """,
+                (result_id, inline_message_id, url, position, JobState.RESOLVE, now, now),
+            ).fetchone()
+        return self._to_job(row)
+
+    def advance(self, job: Job | None, state: JobState) -> None:
+        """Record that `job` reached `state`, does nothing for work that is not tracked by a job."""
+        if job is None or job.state == state:
+            return
+        logger.trace(f'job {job.id} for {job.url}: {job.state} -> {state}')
+        job.state = state
+        with self._lock:
+            self._db.execute('UPDATE jobs SET state = ? WHERE id = ?', (state, job.id))
+
+    async def run(self, job: Job) -> None:
+        """Run `job` now, it is deleted on success and rescheduled on failure. Errors are re-raised."""
+        assert self._runner is not None, 'job queue not started'
+        if job.id in self._running:
+            logger.debug(f'job {job.id} for {job.url} is already running')
+            return
+        self._running.add(job.id)
+        try:
+            await self._runner(job)
+        except Exception as e:
+            self._reschedule(job, e)
+            raise
+        else:
+            with self._lock:
+                self._db.execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+        finally:
+            self._running.discard(job.id)
+
+    def _reschedule(self, job: Job, error: Exception) -> None:
+        job.attempts += 1
+        failure = classify(error)
+        if job.attempts >= MAX_ATTEMPTS or failure in PERMANENT_FAILURES:
+            logger.error(
+                f'giving up on job {job.id} for {job.url} in state {job.state} after {job.attempts} attempts: {failure}'
+            )
+            with self._lock:
+                self._db.execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+            return
+        delay = RETRY_BASE_DELAY * 2 ** (job.attempts - 1)
+        job.next_attempt_at = time.time() + delay
+        logger.warning(f'job {job.id} for {job.url} failed in state {job.state}, retrying in {delay}s: {error}')
+        with self._lock:
+            self._db.execute(
+                'UPDATE jobs SET attempts = ?, next_attempt_at = ? WHERE id = ?',
+                (job.attempts, job.next_attempt_at, job.id),
+            )
+
+    def _due(self) -> list[Job]:
+        rows = self._db.execute('SELECT * FROM jobs WHERE next_attempt_at <= ?', (time.time(),)).fetchall()
+        return [job for job in map(self._to_job, rows) if job.id not in self._running]
+
+    def _to_job(self, row: sqlite3.Row) -> Job:
+        return Job(**dict(row) | {'state': JobState(row['state'])})
+
+    async def start(self, runner: Callable[[Job], Awaitable[None]]) -> None:
+        """Resume the jobs of a previous run and keep retrying failed ones, `runner` does the work."""
+        self._runner = runner
+        if depth := self.depth:
+            logger.info(f'resuming {depth} unfinished jobs, the oldest is {self.oldest_age:.0f}s old')
+        self._task = asyncio.create_task(self._run_periodically())
+
+    async def stop(self) -> None:
+        for task in [self._task, *self._tasks]:
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        with self._lock:
+            self._db.close()
+            self.closed = True
+
+    async def _run_periodically(self) -> None:
+        while True:
+            for job in self._due():
+                task = asyncio.create_task(self._retry(job), name=f'job-{job.id}')
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            if depth := self.depth:
+                logger.debug(f'job queue depth {depth}, oldest job {self.oldest_age:.0f}s old')
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _retry(self, job: Job) -> None:
+        logger.info(f'running job {job.id} for {job.url} from state {job.state}, attempt {job.attempts + 1}')
+        with contextlib.suppress(Exception):  # already logged and rescheduled
+            await self.run(job)
@@ -0,0 +1,27 @@
+import statistics
+from collections import defaultdict, deque
+
+WINDOW = 200  # most recent latencies kept per handler
+MIN_SAMPLES = 20  # below this the p95 is not trusted and the default is used
+
+
+class LatencyTracker:
+    """Recent time each handler took to resolve a link, to tell when one runs unusually long."""
+
+    def __init__(self, default: float):
+        self.default = default
+        self._samples: dict[str, deque[float]] = defaultdict(lambda: deque(maxlen=WINDOW))
+
+    def observe(self, name: str, seconds: float) -> None:
+        self._samples[name].append(seconds)
+
+    def p95(self, name: str) -> float | None:
+        samples = self._samples.get(name)
+        if samples is None or len(samples) < MIN_SAMPLES:
+            return None
+        return statistics.quantiles(samples, n=20)[-1]
+
+    def threshold(self, name: str) -> float:
+        """Seconds after which `name` counts as slow: its p95, or the default until there are enough samples."""
+        p95 = self.p95(name)
+        return p95 if p95 is not None else self.default
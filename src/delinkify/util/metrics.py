@@ -0,0 +1,168 @@
+import contextlib
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Generator
+from pathlib import Path
+
+# upper bounds in seconds, from a cache hit to a long transcode
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    escaped = (v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped, strict=True)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(ABC):
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labels):
+            raise ValueError(f'{self.name} takes labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labels)
+
+    @abstractmethod
+    def samples(self) -> list[str]: ...
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, k)} {_format_value(v)}' for k, v in values]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = (*buckets, math.inf)
+        # per label set: count in each bucket (not cumulative), sum
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Generator[None]:
+        """Observe the seconds the block took, whether or not it raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted((k, (list(counts), total)) for k, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts, strict=True):
+                cumulative += count
+                labels = _format_labels((*self.labels, 'le'), (*key, _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class Callback(Metric):
+    """A value read from the rest of the bot when the metrics are rendered, like a queue depth.
+
+    `fn` returns None when there is no value to report, e.g. once what it reads is shut down.
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float | None], kind: str = 'gauge'):
+        super().__init__(name, help)
+        self.kind = kind
+        self._fn = fn
+
+    def samples(self) -> list[str]:
+        value = self._fn()
+        return [] if value is None else [f'{self.name} {_format_value(value)}']
+
+
+class Registry:
+    """Metrics of this process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register[M: Metric](self, metric: M) -> M:
+        # callbacks are registered again when the bot is, keep the latest
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, help, labels))
+
+    def callback(self, name: str, help: str, fn: Callable[[], float | None], kind: str = 'gauge') -> Callback:
+        return self.register(Callback(name, help, fn, kind))
+
+    def render(self) -> str:
+        return '\n'.join(m.render() for m in self._metrics.values()) + '\n'
+
+    def dump(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.render())
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'delinkify_stage_seconds',
+    'Seconds spent in each stage of turning a link into media, by handler where there is one',
+    ('stage', 'handler'),
+)
+cache_lookups = registry.counter(
+    'delinkify_cache_lookups_total',
+    'Media cache lookups by what was looked up (url or result_id) and whether it was found',
+    ('by', 'result'),
+)
+downloaded_bytes = registry.counter('delinkify_downloaded_bytes_total', 'Bytes of media downloaded', ('handler',))
+uploaded_bytes = registry.counter('delinkify_uploaded_bytes_total', 'Bytes of media uploaded to telegram', ('kind',))
+transcode_cpu_seconds = registry.counter(
+    'delinkify_transcode_cpu_seconds_total',
+    'Cpu seconds ffmpeg used, by what it was asked to do',
+    ('action',),
+)
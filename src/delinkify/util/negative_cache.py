@@ -0,0 +1,120 @@
+import re
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+from enum import StrEnum
+
+from gallery_dl import exception as gdl_exception
+from loguru import logger
+
+from delinkify.util.video import TooLargeError
+
+
+class FailureClass(StrEnum):
+    NOT_FOUND = 'not found'
+    LOGIN_REQUIRED = 'login required'
+    RATE_LIMITED = 'rate limited'
+    TOO_LARGE = 'too large'
+    UNSUPPORTED = 'unsupported'
+    UNKNOWN = 'unknown'
+
+
+# seconds a url is refused after its first failure, doubled on every consecutive failure
+BASE_TTL = {
+    FailureClass.NOT_FOUND: 3600,
+    FailureClass.LOGIN_REQUIRED: 1800,
+    FailureClass.RATE_LIMITED: 60,
+    FailureClass.TOO_LARGE: 86400,
+    FailureClass.UNSUPPORTED: 86400,
+    FailureClass.UNKNOWN: 120,
+}
+
+# patterns matched against yt-dlp and gallery-dl error messages, checked in order
+FAILURE_HINTS = [
+    (FailureClass.RATE_LIMITED, re.compile(r"(error|status|')\W*429\b|rate.?limit|too many requests")),
+    (
+        FailureClass.LOGIN_REQUIRED,
+        re.compile(r"(error|status|')\W*40[13]\b|log ?in|sign in|authenticat|private|cookies"),
+    ),
+    (FailureClass.TOO_LARGE, re.compile(r'larger than|too large|too big|max-filesize')),
+    (
+        FailureClass.NOT_FOUND,
+        re.compile(r"(error|status|')\W*(404|410)\b|not found|does not exist|unavailable|deleted|no longer has media"),
+    ),
+    (FailureClass.UNSUPPORTED, re.compile(r'unsupported|could not determine mimetype')),
+]
+
+# failures that retrying within minutes or hours will not fix
+PERMANENT_FAILURES = {FailureClass.NOT_FOUND, FailureClass.TOO_LARGE, FailureClass.UNSUPPORTED}
+
+
+def classify(error: BaseException | None) -> FailureClass:
+    """Best effort guess at why a handler failed, None means it found no media."""
+    if error is None:
+        return FailureClass.NOT_FOUND
+    # handler errors wrap the extractor error, look at the whole chain
+    messages = []
+    while error is not None:
+        if isinstance(error, TooLargeError):
+            return FailureClass.TOO_LARGE
+        if isinstance(error, gdl_exception.NotFoundError):
+            return FailureClass.NOT_FOUND
+        if isinstance(error, gdl_exception.AuthenticationError | gdl_exception.AuthorizationError):
+            return FailureClass.LOGIN_REQUIRED
+        messages.append(str(error).lower())
+        error = error.__cause__ or error.__context__
+    text = ' '.join(messages)
+    for failure, pattern in FAILURE_HINTS:
+        if pattern.search(text):
+            return failure
+    return FailureClass.UNKNOWN
+
+
+@dataclass
+class Failure:
+    failure: FailureClass
+    count: int
+    expires_at: float
+
+    @property
+    def is_live(self) -> bool:
+        return time.time() < self.expires_at
+
+
+class NegativeCache:
+    """Remembers urls that could not be delinkified so they are refused without retrying.
+
+    Each failure blocks the url for the base ttl of its `FailureClass`, doubled for every
+    consecutive failure up to `max_ttl`. Entries outlive their ttl to keep the failure count,
+    up to `max_entries` of them are kept in LRU order. A success clears the entry.
+    """
+
+    def __init__(self, max_entries: int, max_ttl: int, key_fn: Callable[[str], str] = lambda url: url):
+        self._max_entries = max_entries
+        self._max_ttl = max_ttl
+        self._key_fn = key_fn
+        self._entries: OrderedDict[str, Failure] = OrderedDict()
+
+    def __contains__(self, url: str) -> bool:
+        return self.get(url) is not None
+
+    def get(self, url: str) -> Failure | None:
+        """Return the live failure recorded for `url`, if any."""
+        entry = self._entries.get(self._key_fn(url))
+        return entry if entry is not None and entry.is_live else None
+
+    def record(self, url: str, failure: FailureClass) -> Failure:
+        key = self._key_fn(url)
+        previous = self._entries.pop(key, None)
+        count = previous.count + 1 if previous is not None else 1
+        ttl = min(BASE_TTL[failure] * 2 ** (count - 1), self._max_ttl)
+        entry = self._entries[key] = Failure(failure, count, time.time() + ttl)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        logger.info(f'refusing {key} for {ttl}s: {failure} (failure #{count})')
+        return entry
+
+    def clear(self, url: str) -> None:
+        if self._entries.pop(self._key_fn(url), None) is not None:
+            logger.debug(f'cleared failures for {url}')
@@ -0,0 +1,106 @@
+import asyncio
+import contextlib
+import itertools
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+from loguru import logger
+
+from delinkify.media.media import Media, MediaCollection
+from delinkify.util.content import total_size
+
+MAX_QUEUED = 100
+
+
+class TokenBucket:
+    """Limits throughput to `rate` bytes per second on average, allowing bursts of `burst` bytes.
+
+    Bytes are paid for after they are sent, a caller that overdraws the bucket waits until it
+    is back in credit.
+    """
+
+    def __init__(self, rate: int, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+
+    async def consume(self, n: int) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated_at) * self.rate, self.burst) - n
+        self._updated_at = now
+        if self._tokens < 0:
+            delay = -self._tokens / self.rate
+            logger.debug(f'upload budget exhausted, pausing prefetch for {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+
+@dataclass
+class PrefetchJob:
+    collection: MediaCollection
+    media: Media
+    work: Callable[[Media], Awaitable[Media]]
+
+
+class Prefetcher:
+    """Materializes resolved media in the background, before anybody chooses them.
+
+    Media of single-item collections go first, then the first `items` of each gallery in
+    order. At most `workers` media are materialized at once and, when `kbps` is set, uploads
+    are paced to that bandwidth so prefetching does not starve interactive uploads.
+    """
+
+    def __init__(self, workers: int, items: int, kbps: int):
+        self.workers = workers
+        self.items = items
+        self._bucket = TokenBucket(kbps * 1000 // 8, kbps * 1000 // 8 * 10) if kbps else None
+        self._queue: asyncio.PriorityQueue[tuple[int, int, int, PrefetchJob]] = asyncio.PriorityQueue(MAX_QUEUED)
+        self._seq = itertools.count()
+        self._queued: set[str] = set()
+        self._tasks: list[asyncio.Task] = []
+        logger.info(f'prefetcher: {workers} workers, {items} items per collection, {kbps or "unlimited"} kbps')
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work(i), name=f'prefetcher-{i}') for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    def submit(self, mc: MediaCollection, work: Callable[[Media], Awaitable[Media]]) -> None:
+        """Queue the media of `mc` that are not materialized yet, `work` materializes one of them."""
+        gallery = int(len(mc) > 1)
+        for position, m in enumerate(list(mc.media.values())[: self.items]):
+            if m.is_materialized or m.result_id in self._queued:
+                continue
+            try:
+                self._queue.put_nowait((gallery, position, next(self._seq), PrefetchJob(mc, m, work)))
+            except asyncio.QueueFull:
+                logger.debug(f'prefetch queue full, skipping the rest of {mc.url}')
+                return
+            self._queued.add(m.result_id)
+        logger.trace(f'prefetch queue depth {self._queue.qsize()}')
+
+    async def _work(self, worker: int) -> None:
+        while True:
+            _, _, _, job = await self._queue.get()
+            self._queued.discard(job.media.result_id)
+            if job.media.is_materialized:
+                continue
+            start = time.monotonic()
+            try:
+                m = await job.work(job.media)
+            except Exception as e:
+                logger.warning(f'prefetcher-{worker}: could not materialize {job.media.url}: {e}')
+                continue
+            size = await asyncio.to_thread(total_size, [m.source])
+            logger.info(
+                f'prefetcher-{worker}: materialized {m.result_id} of {m.url} '
+                f'({size / (1024 * 1024):.2f}mb) in {time.monotonic() - start:.1f}s'
+            )
+            if self._bucket is not None:
+                await self._bucket.consume(size)
@@ -0,0 +1,90 @@
+"""Micro-benchmark for router dispatch latency as the number of handlers grows.
+
+Run with `python -m delinkify.util.router_bench`.
+"""
+
+import functools
+import random
+import re
+import sys
+import time
+from typing import TYPE_CHECKING
+
+from loguru import logger
+
+from delinkify.handler import Handler
+from delinkify.handler.router import Router
+from delinkify.media.media import MediaCollection
+
+if TYPE_CHECKING:
+    from delinkify.context import DelinkifyContext
+
+HANDLER_COUNTS = [8, 32, 128, 512, 2048]
+LOOKUPS = 20_000
+LINEAR_LOOKUPS = 200  # the baseline recompiles patterns once they overflow the `re` cache, keep it short
+DISTINCT_URLS = 500
+
+
+class SyntheticHandler(Handler):
+    """Only ever matched against, resolves every link to an empty collection."""
+
+    async def handle(self, url: str, context: DelinkifyContext) -> MediaCollection:
+        return MediaCollection(url, self.name)
+
+    async def download(self, mc: MediaCollection, context: DelinkifyContext) -> None:
+        pass
+
+
+def synthetic_handler(i: int) -> type[Handler]:
+    return type(
+        f'Synthetic{i}',
+        (SyntheticHandler,),
+        {
+            'url_patterns': [
+                rf'^https://(www\.)?site{i}\.com/[\w-]+/post/(?P<id>\d+)',
+                rf'^https://(www\.)?site{i}\.com/p/(?P<id>\w+)',
+            ],
+            'domains': [f'site{i}.com'],
+            'weight': i % 3 * 500,
+        },
+    )
+
+
+def linear_scan(router: Router, url: str) -> list[Handler]:
+    """Dispatch like the router did before indexing, as a baseline."""
+    enabled = [h for h in router.handlers if h.weight >= 0]
+    valid = [h for h in enabled if any(re.match(p, url) for p in h.url_patterns)]
+    return sorted(valid, key=lambda h: h.weight, reverse=True)
+
+
+def per_lookup_us(fn, urls: list[str]) -> float:
+    start = time.perf_counter()
+    for url in urls:
+        fn(url)
+    return (time.perf_counter() - start) / len(urls) * 1e6
+
+
+def main() -> None:
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', format='{message}')
+    rng = random.Random(0)
+
+    logger.info(f'{"handlers":>8} {"linear":>10} {"indexed":>10} {"memoized":>10}  (us per lookup)')
+    for count in HANDLER_COUNTS:
+        logger.disable('delinkify')
+        router = Router([synthetic_handler(i) for i in range(count)])
+        logger.enable('delinkify')
+
+        distinct = [
+            f'https://site{rng.randrange(count)}.com/user/post/{rng.randrange(10**9)}' for _ in range(DISTINCT_URLS)
+        ]
+        urls = [rng.choice(distinct) for _ in range(LOOKUPS)]
+
+        linear = per_lookup_us(functools.partial(linear_scan, router), urls[:LINEAR_LOOKUPS])
+        indexed = per_lookup_us(router.match_handlers, urls)
+        memoized = per_lookup_us(router.get_handlers, urls)
+        logger.info(f'{count:>8} {linear:>10.2f} {indexed:>10.2f} {memoized:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urljoin
+
+import httpx
+from loguru import logger
+
+from delinkify.util.singleflight import SingleFlight
+from delinkify.util.url import canonicalize
+
+# canonical urls that only redirect to the post they stand for
+SHORT_LINK_PATTERNS = [
+    re.compile(p)
+    for p in [
+        r'^https://(vm|vt)\.tiktok\.com/\w+',
+        r'^https://tiktok\.com/t/\w+',
+        r'^https://reddit\.com/r/\w+/s/\w+',
+        r'^https://redd\.it/\w+',
+        r'^https://youtu\.be/[\w-]+',
+        r'^https://dai\.ly/\w+',
+        r'^https://instagram\.com/share/(reel/|p/)?[\w-]+',
+        r'^https://t\.co/\w+',
+    ]
+]
+
+MAX_REDIRECTS = 5
+MAX_ENTRIES = 4096
+TIMEOUT = 5  # seconds to follow the whole chain, the link is passed on unresolved after that
+FAILURE_TTL = 60  # seconds a link that could not be followed is passed on without trying again
+# some sites only redirect browsers, the rest do not care
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0'
+
+
+def is_short_link(url: str) -> bool:
+    return any(p.match(url) for p in SHORT_LINK_PATTERNS)
+
+
+class ShortLinkResolver:
+    """Follows short links (`vm.tiktok.com`, reddit `/s/`, `youtu.be`...) to the url of their post.
+
+    Redirects are followed with HEAD requests over a shared pool of keep-alive connections, only
+    until the location is no longer a short link. Resolved links are remembered for `ttl` seconds,
+    up to `MAX_ENTRIES` of them in LRU order. Links that cannot be resolved are returned as they
+    are, the extractors may still manage with them, and remembered as such for `FAILURE_TTL`.
+    """
+
+    def __init__(self, ttl: int, transport: httpx.AsyncBaseTransport | None = None):
+        self.ttl = ttl
+        self._client = httpx.AsyncClient(
+            headers={'User-Agent': USER_AGENT},
+            timeout=TIMEOUT,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+            transport=transport,
+        )
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._flights: SingleFlight[str] = SingleFlight('short-link')
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, url: str) -> str:
+        """Return the url `url` redirects to if it is a short link, canonicalized, or `url` itself."""
+        if not is_short_link(url):
+            return url
+        entry = self._entries.get(url)
+        if entry is not None and time.time() < entry[1]:
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        try:
+            target = await self._flights.do(url, lambda: self._follow(url))
+        except (httpx.HTTPError, httpx.InvalidURL, TimeoutError) as e:
+            logger.warning(f'could not resolve short link {url}: {e!r}')
+            # a dead link would take up to `TIMEOUT` of every query for it otherwise
+            self._remember(url, url, FAILURE_TTL)
+            return url
+        self._remember(url, target, self.ttl)
+        logger.debug(f'resolved short link {url} to {target}')
+        return target
+
+    def _remember(self, url: str, target: str, ttl: float) -> None:
+        self._entries[url] = (target, time.time() + ttl)
+        self._entries.move_to_end(url)
+        while len(self._entries) > MAX_ENTRIES:
+            self._entries.popitem(last=False)
+
+    async def _follow(self, url: str) -> str:
+        async with asyncio.timeout(TIMEOUT):
+            for _ in range(MAX_REDIRECTS):
+                location = await self._location(url)
+                if location is None:
+                    break
+                url = canonicalize(urljoin(url, location))
+                if not is_short_link(url):
+                    break
+        return url
+
+    async def _location(self, url: str) -> str | None:
+        response = await self._client.head(url)
+        if response.status_code == httpx.codes.METHOD_NOT_ALLOWED:
+            # the headers are enough, the body is never read
+            async with self._client.stream('GET', url) as response:
+                pass
+        if not response.has_redirect_location:
+            response.raise_for_status()
+            return None
+        return response.headers['location']
+
+    async def close(self) -> None:
+        await self._client.aclose()
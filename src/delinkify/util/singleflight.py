@@ -0,0 +1,74 @@
+import asyncio
+from collections.abc import Callable, Coroutine
+from dataclasses import dataclass
+from typing import Any
+
+from loguru import logger
+
+
+@dataclass
+class Flight[T]:
+    task: asyncio.Task[T]
+    waiters: int = 0
+
+
+class SingleFlight[T]:
+    """Deduplicates concurrent work sharing the same key.
+
+    The first caller for a key starts the work, later callers await the same task and get
+    the same result (or exception). If every waiter goes away, the work is cancelled, unless
+    they stopped waiting because their `max_wait` ran out: that work keeps running in the
+    background so its result is not lost.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: dict[str, Flight[T]] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(
+        self,
+        key: str,
+        factory: Callable[[], Coroutine[Any, Any, T]],
+        max_wait: float | None = None,
+    ) -> T:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._start(key, factory)
+        else:
+            logger.debug(f'{self.name}: joining in-flight work for {key} ({flight.waiters} waiting)')
+
+        flight.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.task), max_wait)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                logger.debug(f'{self.name}: all waiters gone, cancelling flight for {key}')
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def start(self, key: str, factory: Callable[[], Coroutine[Any, Any, T]]) -> None:
+        """Start the work for `key` in the background without waiting for it, unless it is already in flight."""
+        if key not in self._flights:
+            self._start(key, factory)
+
+    def _start(self, key: str, factory: Callable[[], Coroutine[Any, Any, T]]) -> Flight[T]:
+        flight = Flight(task=asyncio.create_task(factory(), name=f'{self.name}:{key}'))
+        self._flights[key] = flight
+        flight.task.add_done_callback(lambda _: self._land(key, flight))
+        logger.trace(f'{self.name}: started flight for {key}')
+        return flight
+
+    def _land(self, key: str, flight: Flight[T]) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # nobody is left to see the outcome of work that outlived its waiters, log it instead
+        if flight.waiters == 0 and not flight.task.cancelled() and (e := flight.task.exception()):
+            logger.opt(exception=e).warning(f'{self.name}: background flight for {key} failed')
@@ -0,0 +1,143 @@
+import asyncio
+import contextlib
+import functools
+import itertools
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from enum import IntEnum
+from pathlib import Path
+
+from loguru import logger
+
+from delinkify.util.video import shrink
+
+HISTORY_SIZE = 100
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # somebody is waiting for the message to update
+    BACKGROUND = 1  # materializing ahead of time, nobody is waiting yet
+
+
+@dataclass
+class TranscodeJob:
+    name: str
+    output_path: Path
+    work: Callable[[int], Awaitable[Path]]  # called with the thread budget of the job
+    priority: Priority
+    future: asyncio.Future[Path]
+    queued_at: float = field(default_factory=time.monotonic)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def queue_wait(self) -> float:
+        return (self.started_at or time.monotonic()) - self.queued_at
+
+    @property
+    def encode_time(self) -> float | None:
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+
+class Transcoder:
+    """Runs ffmpeg jobs on a fixed number of workers, in priority order.
+
+    Each ffmpeg process is limited to `threads` threads, so `workers * threads` bounds the cores
+    transcoding takes. Jobs for the same output are shared, a background job that an interactive
+    request joins is bumped to the front of the queue. The last finished jobs are kept in
+    `history` along with their queue wait and encode time.
+    """
+
+    def __init__(self, workers: int, threads: int):
+        self.workers = workers
+        self.threads = threads
+        self.history: deque[TranscodeJob] = deque(maxlen=HISTORY_SIZE)
+        self._queue: asyncio.PriorityQueue[tuple[Priority, int, TranscodeJob]] = asyncio.PriorityQueue()
+        self._seq = itertools.count()  # keeps the queue fifo within a priority
+        self._jobs: dict[Path, TranscodeJob] = {}
+        self._tasks: list[asyncio.Task] = []
+        logger.info(f'transcoder: {workers} workers, {threads} threads per job')
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.started_at is None)
+
+    @property
+    def running(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.started_at is not None)
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work(i), name=f'transcoder-{i}') for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        for job in self._jobs.values():
+            job.future.cancel()
+
+    async def shrink(self, input_path: Path, output_path: Path, priority: Priority = Priority.INTERACTIVE) -> Path:
+        """Queue a `shrink` of `input_path` and wait for it, returns the path to send."""
+        work = functools.partial(self._shrink, input_path, output_path)
+        return await self.run(input_path.name, output_path, work, priority)
+
+    async def run(
+        self,
+        name: str,
+        output_path: Path,
+        work: Callable[[int], Awaitable[Path]],
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> Path:
+        """Queue `work` producing `output_path` and wait for it, `work` gets the thread budget of the job."""
+        job = self._jobs.get(output_path)
+        if job is None:
+            job = TranscodeJob(name, output_path, work, priority, asyncio.get_running_loop().create_future())
+            self._jobs[output_path] = job
+            self._queue.put_nowait((priority, next(self._seq), job))
+        else:
+            self.bump(output_path, priority)
+        logger.trace(f'queued transcode of {name}, queue depth {self.queue_depth}, running {self.running}')
+        return await asyncio.shield(job.future)
+
+    def bump(self, output_path: Path, priority: Priority = Priority.INTERACTIVE) -> None:
+        """Raise the priority of the queued job producing `output_path`, if there is one."""
+        job = self._jobs.get(output_path)
+        if job is None or priority >= job.priority or job.started_at is not None:
+            return
+        # the stale entry is skipped once this one has been picked up
+        logger.debug(f'bumping transcode of {job.name} to {priority.name}')
+        job.priority = priority
+        self._queue.put_nowait((priority, next(self._seq), job))
+
+    @staticmethod
+    async def _shrink(input_path: Path, output_path: Path, threads: int) -> Path:
+        return await shrink(input_path, output_path, threads=threads)
+
+    async def _work(self, worker: int) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            if job.started_at is not None or job.future.done():
+                continue
+            job.started_at = time.monotonic()
+            try:
+                result = await job.work(self.threads)
+            except Exception as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                if not job.future.done():  # the worker was cancelled mid-job
+                    job.future.cancel()
+                job.finished_at = time.monotonic()
+                del self._jobs[job.output_path]
+                self.history.append(job)
+            logger.info(
+                f'transcoder-{worker}: {job.name} ({job.priority.name}) waited {job.queue_wait:.1f}s, '
+                f'took {job.encode_time:.1f}s'
+            )
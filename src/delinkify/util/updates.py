@@ -0,0 +1,141 @@
+import asyncio
+import heapq
+import itertools
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any
+
+from loguru import logger
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from delinkify.util.url import canonicalize
+
+# updates the application may hand over before it has to wait, the limit proper is enforced here
+MAX_ADMITTED = 1024
+
+
+class UpdatePriority(IntEnum):
+    CHOSEN = 0  # somebody is looking at the placeholder message
+    QUERY = 1
+    OTHER = 2
+
+
+def update_priority(update: object) -> UpdatePriority:
+    if isinstance(update, Update):
+        if update.chosen_inline_result is not None:
+            return UpdatePriority.CHOSEN
+        if update.inline_query is not None:
+            return UpdatePriority.QUERY
+    return UpdatePriority.OTHER
+
+
+class PrioritySemaphore:
+    """Semaphore whose waiters are woken lowest priority value first, in arrival order within one."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, f in self._waiters if not f.done())
+
+    async def acquire(self, priority: int) -> None:
+        if self._value > 0 and not self.waiting:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():  # woken up and cancelled at once, pass it on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+@dataclass
+class KeyLock:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    users: int = 0
+
+
+class DelinkifyUpdateProcessor(BaseUpdateProcessor):
+    """Processes up to `limit` updates at once, chosen results first, keeping per-link order.
+
+    Inline queries for the same link (as keyed by `key_fn`, the cache key) are processed one
+    after another in the order they arrived. A chosen result waits for the queries for its link
+    that arrived before it, so it is never delivered while one is still running, but does not
+    hold later queries up while its media downloads and uploads. Among the updates waiting for a
+    free slot, chosen results go before inline queries.
+    """
+
+    def __init__(self, limit: int, key_fn: Callable[[str], str] = lambda url: url):
+        super().__init__(max(limit, MAX_ADMITTED))
+        self.limit = limit
+        self._key_fn = key_fn
+        self._slots = PrioritySemaphore(limit)
+        self._locks: dict[str, KeyLock] = {}
+        self.running = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._slots.waiting
+
+    def key(self, update: object) -> str | None:
+        if not isinstance(update, Update):
+            return None
+        query = update.inline_query or update.chosen_inline_result
+        if query is None or not query.query.strip().startswith('https://'):
+            return None
+        return self._key_fn(canonicalize(query.query.strip()))
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.key(update)
+        if key is None:
+            await self._run(update, coroutine)
+            return
+
+        entry = self._locks.setdefault(key, KeyLock())
+        entry.users += 1
+        chosen = update_priority(update) == UpdatePriority.CHOSEN
+        try:
+            if entry.lock.locked():
+                logger.trace(f'update for {key} waits for an earlier one')
+            async with entry.lock:
+                if not chosen:
+                    await self._run(update, coroutine)
+        finally:
+            entry.users -= 1
+            if not entry.users:
+                del self._locks[key]
+        if chosen:
+            # the earlier queries for its link are done, later ones need not wait for the delivery
+            await self._run(update, coroutine)
+
+    async def _run(self, update: object, coroutine: Awaitable[Any]) -> None:
+        priority = update_priority(update)
+        await self._slots.acquire(priority)
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    async def initialize(self) -> None:
+        logger.info(f'processing up to {self.limit} updates at once')
+
+    async def shutdown(self) -> None:
+        pass
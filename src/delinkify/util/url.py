@@ -0,0 +1,71 @@
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# hosts that serve the same content, mapped to the form the handlers and extractors expect
+HOST_ALIASES = {
+    'twitter.com': 'x.com',
+    'www.twitter.com': 'x.com',
+    'mobile.twitter.com': 'x.com',
+    'www.x.com': 'x.com',
+    'mobile.x.com': 'x.com',
+    'www.reddit.com': 'reddit.com',
+    'old.reddit.com': 'reddit.com',
+    'new.reddit.com': 'reddit.com',
+    'm.reddit.com': 'reddit.com',
+    'www.instagram.com': 'instagram.com',
+    'm.instagram.com': 'instagram.com',
+    'www.youtube.com': 'youtube.com',
+    'm.youtube.com': 'youtube.com',
+    'www.tiktok.com': 'tiktok.com',
+    'm.tiktok.com': 'tiktok.com',
+    'www.dailymotion.com': 'dailymotion.com',
+}
+
+TRACKING_PARAMS = {
+    '_r',
+    '_t',
+    'fbclid',
+    'feature',
+    'gclid',
+    'igsh',
+    'igshid',
+    'is_from_webapp',
+    'ref',
+    'ref_source',
+    'ref_src',
+    'ref_url',
+    's',
+    'sender_device',
+    'share_id',
+    'si',
+    't',
+}
+
+
+def is_tracking_param(name: str) -> bool:
+    return name in TRACKING_PARAMS or name.startswith('utm_')
+
+
+def canonicalize(url: str) -> str:
+    """Normalize `url` so that equivalent links compare equal.
+
+    Lowercases the scheme and host, maps host aliases, drops tracking parameters, the fragment
+    and any trailing slash.
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    host = HOST_ALIASES.get(host, host)
+    if parts.port and parts.port != 443:
+        host = f'{host}:{parts.port}'
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not is_tracking_param(k)])
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower(), host, path, query, ''))
+
+
+def media_dir_for(url: str, handler: str | None = None) -> str:
+    """Name of the directory the files of `url` resolved by `handler` are downloaded to.
+
+    Each handler gets its own, so handlers racing for the same url never write to the same one.
+    """
+    name = f'{handler}:{url}' if handler else url
+    return hashlib.sha256(name.encode()).hexdigest()[:32]
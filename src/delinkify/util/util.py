@@ -1,10 +1,40 @@
+import atexit
+import contextlib
+import os
+import sys
+import threading
+import time
+from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
 import gallery_dl
-from gallery_dl.job import DownloadJob
+from gallery_dl import exception
+from gallery_dl.extractor.message import Message
+from gallery_dl.job import DataJob, DownloadJob, Job
+from gallery_dl.path import PathFormat
 from loguru import logger
+from yt_dlp import YoutubeDL
+from yt_dlp.postprocessor import FFmpegMergerPP
+from yt_dlp.utils import DownloadError
 
-from delinkify.context import DelinkifyContext
+from delinkify.util.extractors import ExtractorPool
+from delinkify.util.video import TooLargeError
+
+if TYPE_CHECKING:
+    from requests import Session
+
+    from delinkify.context import DelinkifyContext
+
+# warm instances per handler, reused across requests instead of built for every call
+ydl_pool: ExtractorPool[YoutubeDL] = ExtractorPool('yt-dlp', YoutubeDL.close)
+gdl_sessions: ExtractorPool[Session] = ExtractorPool('gallery-dl session', lambda session: session.close())
+atexit.register(ydl_pool.close)
+atexit.register(gdl_sessions.close)
+
+_gdl_configured: set[tuple[str, str, str | None]] = set()
+_gdl_config_lock = threading.Lock()
 
 
 def get_cookie_file_path(handler: str, context: DelinkifyContext) -> str | None:
@@ -17,26 +47,233 @@ def get_cookie_file_path(handler: str, context: DelinkifyContext) -> str | None:
     return None
 
 
-def gdl(
+def gdl_configure(category: str, filename: str, cookie_file_path: str | None = None) -> None:
+    """Set the options of `category` in gallery-dl's global config.
+
+    They are the same for every request, so this only writes them the first time. Whatever
+    differs per request (the output directory) is set on the job instead, see `gdl_job`.
+    """
+    with _gdl_config_lock:
+        if (category, filename, cookie_file_path) in _gdl_configured:
+            return
+        gallery_dl.config.set(('extractor', category), 'directory', [])
+        gallery_dl.config.set(('extractor', category), 'filename', filename)
+        gallery_dl.config.set(
+            ('extractor',),
+            'postprocessors',
+            [
+                {
+                    'name': 'metadata',
+                    'event': 'post',
+                    'mode': 'json',
+                }
+            ],
+        )
+        if cookie_file_path:
+            gallery_dl.config.set(('extractor', category), 'cookies', cookie_file_path)
+        _gdl_configured.add((category, filename, cookie_file_path))
+
+
+@contextlib.contextmanager
+def gdl_job[J: Job](
+    key: str, job_class: type[J], url: str, media_path: Path | None = None, **kwargs: Any
+) -> Generator[J]:
+    """Build a gallery-dl job for `url` on a warm session of handler `key`, writing to `media_path`."""
+    extr = gallery_dl.extractor.find(url)
+    if extr is None:
+        raise exception.NoExtractorError
+    if media_path is not None:
+        # used as is instead of the base directory, child extractors inherit it
+        extr._parentdir = f'{media_path}{os.sep}'
+    job = job_class(extr, **kwargs)
+
+    def create() -> Session:
+        extr.initialize()
+        return extr.session
+
+    with gdl_sessions.checkout(key, create) as session:
+        extr.session = session
+        yield job
+
+
+def gdl_run(
+    key: str,
     url: str,
     media_path: Path,
+    category: str,
+    filename: str,
     cookie_file_path: str | None = None,
-) -> DownloadJob:
-    gallery_dl.config.set(('extractor',), 'base-directory', str(media_path))
-    gallery_dl.config.set(('extractor', 'reddit'), 'directory', [])
-    gallery_dl.config.set(('extractor', 'reddit'), 'filename', '{id}_{num:>02}.{extension}')
-    gallery_dl.config.set(
-        ('extractor',),
-        'postprocessors',
-        [
-            {
-                'name': 'metadata',
-                'event': 'post',
-                'mode': 'json',
-            }
-        ],
-    )
-    if cookie_file_path:
-        gallery_dl.config.set(('extractor', 'reddit'), 'cookies', cookie_file_path)
-
-    return DownloadJob(url)
+) -> int:
+    """Build and run a gallery-dl download job. Blocking, meant to run in the download executor."""
+    gdl_configure(category, filename, cookie_file_path)
+    with gdl_job(key, DownloadJob, url, media_path) as job:
+        return job.run()
+
+
+def gdl_probe(
+    key: str,
+    url: str,
+    media_path: Path,
+    category: str,
+    filename: str,
+    cookie_file_path: str | None = None,
+) -> list[tuple[Path, str, dict[str, Any]]]:
+    """Collect the metadata of every file behind `url` without downloading anything.
+
+    Returns the path each file will be downloaded to along with its url and metadata. Nothing is
+    returned for posts that hand over to other extractors (galleries, redirects), only a download
+    follows those.
+    """
+    gdl_configure(category, filename, cookie_file_path)
+    with gdl_job(key, DataJob, url, media_path, file=None) as job:
+        job.run()
+        if job.exception is not None:
+            raise job.exception
+        if any(message[0] == Message.Queue for message in job.data):
+            return []
+        # the same paths a download job would build, sanitized and with mapped extensions
+        pathfmt = PathFormat(job.extractor)
+        pathfmt.set_directory({})
+        files = []
+        for message in job.data:
+            if message[0] == Message.Directory:
+                pathfmt.set_directory(message[1])
+            elif message[0] == Message.Url:
+                _, file_url, kwdict = message
+                pathfmt.set_filename(kwdict)
+                pathfmt.build_path()
+                files.append((Path(pathfmt.realpath), file_url, kwdict))
+        return files
+
+
+@contextlib.contextmanager
+def ydl(key: str, params: dict[str, Any], media_path: Path) -> Generator[YoutubeDL]:
+    """Check out a warm `YoutubeDL` of handler `key`, writing to `media_path`.
+
+    `params` are only used to build a new instance, they must be the same for every request of
+    `key`. The output template in them should be relative, it is resolved under `media_path`.
+    """
+    with ydl_pool.checkout(key, lambda: YoutubeDL(params=dict(params))) as instance:
+        instance.params['paths'] = {'home': str(media_path)}
+        yield instance
+
+
+def check_downloaded(info: dict[str, Any], source: Path, params: dict[str, Any]) -> None:
+    """Raise if yt-dlp skipped `source` for being over `max_filesize`, it only logs that."""
+    limit = params.get('max_filesize')
+    if not limit or source.exists():
+        return
+    size = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in info.get('requested_formats') or [info])
+    if size > limit:
+        raise TooLargeError(f'{source.name} is larger than max-filesize ({size} > {limit} bytes)')
+
+
+def ydl_download(key: str, url: str, params: dict[str, Any], media_path: Path) -> tuple[dict[str, Any], Path]:
+    """Download `url` with yt-dlp. Blocking, meant to run in the download executor.
+
+    Returns the sanitized info dict and the path of the downloaded file.
+    """
+    with ydl(key, params, media_path) as instance:
+        info = instance.extract_info(url, download=True)
+        source = Path(instance.prepare_filename(info))
+    check_downloaded(info, source, params)
+    return YoutubeDL.sanitize_info(info), source
+
+
+def ydl_probe(key: str, url: str, params: dict[str, Any], media_path: Path) -> tuple[dict[str, Any], Path]:
+    """Extract the metadata for `url` with yt-dlp without downloading.
+
+    Returns the sanitized info dict and the path the file will be downloaded to.
+    """
+    with ydl(key, params, media_path) as instance:
+        info = instance.extract_info(url, download=False)
+        source = Path(instance.prepare_filename(info))
+    return YoutubeDL.sanitize_info(info), source
+
+
+def ydl_download_info(
+    key: str, info: dict[str, Any], params: dict[str, Any], media_path: Path
+) -> tuple[dict[str, Any], Path]:
+    """Download a previously extracted `info`, without extracting it again."""
+    with ydl(key, params, media_path) as instance:
+        info = instance.process_ie_result(info, download=True)
+        source = Path(instance.prepare_filename(info))
+    check_downloaded(info, source, params)
+    return YoutubeDL.sanitize_info(info), source
+
+
+def ydl_download_streams(
+    key: str, info: dict[str, Any], params: dict[str, Any], media_path: Path
+) -> tuple[dict[str, Any], Path]:
+    """Download the formats of a previously extracted `info` that get merged all at once, then merge them.
+
+    yt-dlp downloads them one after another, the separate video and audio of a post take as
+    long as both together.
+    """
+    with ydl(key, params, media_path) as instance:
+        output = Path(instance.prepare_filename(info))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        formats = [dict(f) for f in info['requested_formats']]
+
+        def fetch(f: dict[str, Any]) -> Path:
+            path = output.with_suffix(f'.f{f["format_id"]}.{f["ext"]}')
+            stream = {k: v for k, v in info.items() if k != 'requested_formats'} | f
+            success, _ = instance.dl(str(path), stream)
+            if not success:
+                check_downloaded(f, path, params)
+                raise DownloadError(f'could not download format {f["format_id"]}')
+            f['filepath'] = str(path)
+            return path
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(len(formats), thread_name_prefix='delinkify-stream') as pool:
+            paths = list(pool.map(fetch, formats))
+        elapsed = time.perf_counter() - start
+        size = sum(p.stat().st_size for p in paths)
+        logger.info(
+            f'downloaded {len(paths)} streams of {output.name}: {size} bytes in {elapsed:.1f}s{rate(size, elapsed)}'
+        )
+
+        merge = info | {
+            'requested_formats': formats,
+            'filepath': str(output),
+            '__files_to_merge': list(map(str, paths)),
+        }
+        FFmpegMergerPP(instance).run(merge)
+        for p in paths:
+            p.unlink(missing_ok=True)
+    return info, output
+
+
+def rate(size: int, elapsed: float) -> str:
+    return f' ({size / elapsed / 1024 / 1024:.1f} MiB/s)' if elapsed else ''
+
+
+def log_throughput(progress: dict[str, Any]) -> None:
+    """yt-dlp progress hook that logs how fast every file downloaded."""
+    if progress['status'] != 'finished' or not progress.get('elapsed'):
+        return  # files already on disk finish without downloading anything
+    size = progress.get('total_bytes') or progress.get('downloaded_bytes') or 0
+    elapsed = progress['elapsed']
+    logger.info(f'downloaded {Path(progress["filename"]).name}: {size} bytes in {elapsed:.1f}s{rate(size, elapsed)}')
+
+
+def ydl_pipe_command(info_path: Path, format_id: str) -> list[str]:
+    """Command that writes the format `format_id` of the info json at `info_path` to stdout."""
+    # ffmpeg as downloader remuxes to a streamable container (mpegts) instead of piping a raw mp4
+    return [
+        sys.executable,
+        '-m',
+        'yt_dlp',
+        '--quiet',
+        '--no-warnings',
+        '--no-progress',
+        '--load-info-json',
+        str(info_path),
+        '--format',
+        format_id,
+        '--downloader',
+        'ffmpeg',
+        '--output',
+        '-',
+    ]
@@ -1,69 +1,430 @@
 import asyncio
 import json
+import os
+import re
+import struct
+import time
+from dataclasses import dataclass
+from enum import StrEnum
 from pathlib import Path
 
 from loguru import logger
 
+from delinkify.util.metrics import stage_seconds, transcode_cpu_seconds
+
 TARGET_HEIGHT = 480
 MAX_VIDEO_SIZE_MB = 25
 MAX_VIDEO_KBPS = 600  # quality ceiling
 MIN_VIDEO_KBPS = 300  # quality floor
 AUDIO_KBPS = 64
+UNKNOWN_AUDIO_KBPS = 128  # assumed when the container does not report it
+CONTAINER_OVERHEAD = 0.02  # share of the file taken by the container, keeps remux estimates on the safe side
+
+# (height, min kbps, max kbps), highest first. a rung is only used if the size budget reaches its floor
+RESOLUTION_LADDER = [
+    (720, 1200, 1800),
+    (TARGET_HEIGHT, MIN_VIDEO_KBPS, MAX_VIDEO_KBPS),
+]
+
+# codecs telegram plays inline from an mp4
+PLAYABLE_VIDEO_CODECS = {'h264'}
+PLAYABLE_AUDIO_CODECS = {'aac', 'mp3'}
+MP4_FORMATS = {'mov', 'mp4', 'm4a', '3gp', '3g2', 'mj2'}
+
+
+@dataclass
+class VideoInfo:
+    size: int
+    duration: float
+    format_names: set[str]
+    vcodec: str | None
+    acodec: str | None
+    width: int
+    height: int
+    video_kbps: int
+    audio_kbps: int
+    extra_streams: int  # subtitles, data, extra audio tracks... anything a remux can drop
+    faststart: bool
+
+    @property
+    def is_mp4(self) -> bool:
+        return bool(self.format_names & MP4_FORMATS)
+
+    @property
+    def has_playable_codecs(self) -> bool:
+        return self.vcodec in PLAYABLE_VIDEO_CODECS and self.acodec in {*PLAYABLE_AUDIO_CODECS, None}
+
+    @property
+    def is_playable(self) -> bool:
+        return self.is_mp4 and self.has_playable_codecs
 
 
-async def shrink(input_path: Path, output_path: Path) -> None:
+def is_faststart(path: Path) -> bool:
+    """Tell whether the `moov` box of an mp4 comes before `mdat`, so playback can start while downloading."""
+    with path.open('rb') as f:
+        while header := f.read(8):
+            if len(header) < 8:
+                return False
+            size, box = struct.unpack('>I4s', header)
+            if box == b'moov':
+                return True
+            if box == b'mdat':
+                return False
+            if size == 1:  # 64-bit size follows the header
+                size = struct.unpack('>Q', f.read(8))[0] - 8
+            elif size == 0:  # box runs to the end of the file
+                return False
+            f.seek(size - 8, 1)
+    return False
+
+
+async def probe(path: Path) -> VideoInfo:
+    with stage_seconds.time(stage='ffprobe', handler=''):
+        return await _probe(path)
+
+
+async def _probe(path: Path) -> VideoInfo:
     proc = await asyncio.create_subprocess_exec(
         'ffprobe',
         '-v',
         'error',
         '-show_entries',
-        'format=duration',
+        'format=duration,size,bit_rate,format_name:stream=codec_type,codec_name,width,height,bit_rate',
         '-of',
         'json',
-        str(input_path),
+        str(path),
         stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffprobe failed: {stderr.decode()}')
+    data = json.loads(out)
+    fmt = data['format']
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+
+    duration = float(fmt['duration'])
+    size = int(fmt['size'])
+    total_kbps = int(fmt.get('bit_rate') or size * 8 / duration) // 1000
+    audio_kbps = int(audio['bit_rate']) // 1000 if audio.get('bit_rate') else UNKNOWN_AUDIO_KBPS if audio else 0
+    video_kbps = int(video['bit_rate']) // 1000 if video.get('bit_rate') else max(total_kbps - audio_kbps, 0)
+    format_names = set(fmt.get('format_name', '').split(','))
+
+    return VideoInfo(
+        size=size,
+        duration=duration,
+        format_names=format_names,
+        vcodec=video.get('codec_name'),
+        acodec=audio.get('codec_name'),
+        width=int(video.get('width', 0)),
+        height=int(video.get('height', 0)),
+        video_kbps=video_kbps,
+        audio_kbps=audio_kbps,
+        extra_streams=len(streams) - bool(video) - bool(audio),
+        faststart=bool(format_names & MP4_FORMATS) and is_faststart(path),
     )
-    out, _ = await proc.communicate()
-    duration = float(json.loads(out)['format']['duration'])
 
-    size_kbps = (MAX_VIDEO_SIZE_MB * 1024 * 8) / duration - AUDIO_KBPS
-    video_kbps = int(min(size_kbps, MAX_VIDEO_KBPS))
 
-    if video_kbps < MIN_VIDEO_KBPS:
-        raise ValueError(f'video too long: {duration:.0f}s would need {video_kbps}kbps')
+class TooLargeError(ValueError):
+    """The media cannot be brought under the size limit."""
+
+
+class Action(StrEnum):
+    NONE = 'none'  # send as is
+    REMUX = 'remux'  # stream copy into a faststart mp4, dropping extra streams
+    AUDIO = 'audio'  # copy the video stream, re-encode the audio only
+    ENCODE = 'encode'  # full re-encode down the resolution ladder
+    REJECT = 'reject'  # cannot fit the size limit at an acceptable quality
+
+
+@dataclass
+class TranscodePlan:
+    action: Action
+    reason: str
+    height: int | None = None
+    video_kbps: int | None = None
+
+    def ffmpeg_args(self, audio_input: int = 0) -> list[str]:
+        """Output options for ffmpeg, everything between the inputs and the output path.
+
+        The video is taken from the first input and the audio from input `audio_input`.
+        """
+        maps = ['-map', '0:v:0', '-map', f'{audio_input}:a:0?']
+        common = [*maps, '-sn', '-dn', '-movflags', '+faststart', '-f', 'mp4']
+        match self.action:
+            case Action.REMUX:
+                return ['-c', 'copy', *common]
+            case Action.AUDIO:
+                return ['-c:v', 'copy', '-c:a', 'aac', '-b:a', f'{AUDIO_KBPS}k', *common]
+            case Action.ENCODE:
+                assert self.height is not None and self.video_kbps is not None
+                kbps = self.video_kbps
+                return [
+                    '-c:v',
+                    'libx264',
+                    '-vf',
+                    f'scale=-2:{self.height}',
+                    '-b:v',
+                    f'{kbps}k',
+                    '-maxrate',
+                    f'{int(kbps * 1.2)}k',
+                    '-bufsize',
+                    f'{kbps * 2}k',
+                    '-preset',
+                    'fast',
+                    '-c:a',
+                    'aac',
+                    '-b:a',
+                    f'{AUDIO_KBPS}k',
+                    *common,
+                ]
+            case _:
+                raise ValueError(f'plan {self.action} does not run ffmpeg')
+
+    def __str__(self) -> str:
+        if self.action == Action.ENCODE:
+            return f'{self.action} at {self.height}p {self.video_kbps}kbps ({self.reason})'
+        return f'{self.action} ({self.reason})'
+
+
+def estimate_size(info: VideoInfo, video_kbps: int, audio_kbps: int) -> int:
+    payload = (video_kbps + audio_kbps) * 1000 / 8 * info.duration
+    return int(payload * (1 + CONTAINER_OVERHEAD))
+
+
+def plan_transcode(info: VideoInfo, max_bytes: int) -> TranscodePlan:
+    """Pick the cheapest action that gets `info` under `max_bytes` in a format telegram can play."""
+    fits = info.size <= max_bytes
+
+    if fits and not info.is_playable:
+        return TranscodePlan(Action.NONE, f'fits, {info.vcodec}/{info.acodec} is sent as is')
+    if fits and (info.faststart or not info.is_mp4):
+        return TranscodePlan(Action.NONE, 'fits and plays inline')
+    if fits:
+        return TranscodePlan(Action.REMUX, 'fits but the index is at the end of the file')
+
+    if info.has_playable_codecs and estimate_size(info, info.video_kbps, info.audio_kbps) <= max_bytes:
+        return TranscodePlan(Action.REMUX, f'fits without its {info.extra_streams} extra streams')
+    if (
+        info.vcodec in PLAYABLE_VIDEO_CODECS
+        and info.acodec is not None
+        and info.audio_kbps > AUDIO_KBPS
+        and estimate_size(info, info.video_kbps, AUDIO_KBPS) <= max_bytes
+    ):
+        return TranscodePlan(Action.AUDIO, f'fits with the audio cut from {info.audio_kbps}kbps to {AUDIO_KBPS}kbps')
+    return plan_encode(info, max_bytes)
 
-    logger.debug(f'shrinking {duration:.0f}s video at {video_kbps}kbps')
 
+def plan_encode(info: VideoInfo, max_bytes: int) -> TranscodePlan:
+    """Pick the highest rung of the resolution ladder whose bitrate gets `info` under `max_bytes`."""
+    audio_kbps = min(info.audio_kbps, AUDIO_KBPS) if info.acodec else 0
+    budget_kbps = int(max_bytes * 8 / 1000 / info.duration / (1 + CONTAINER_OVERHEAD)) - audio_kbps
+    for height, min_kbps, max_kbps in RESOLUTION_LADDER:
+        if height > info.height and height != RESOLUTION_LADDER[-1][0]:
+            continue  # never upscale, the lowest rung is always available
+        if budget_kbps >= min_kbps:
+            # small sources are scaled to their own height, never up
+            target = min(height, info.height) if info.height else height
+            target -= target % 2
+            return TranscodePlan(Action.ENCODE, f'budget of {budget_kbps}kbps', target, min(budget_kbps, max_kbps))
+    return TranscodePlan(Action.REJECT, f'{info.duration:.0f}s would need {budget_kbps}kbps')
+
+
+class EncodeCost:
+    """Running estimate of the cpu seconds a full re-encode takes, per megapixel-second of output.
+
+    Seeded with a rough figure for libx264 `fast`, then calibrated with every encode that runs.
+    """
+
+    def __init__(self, cpu_per_mpx_second: float = 0.75, alpha: float = 0.2):
+        self.cpu_per_mpx_second = cpu_per_mpx_second
+        self._alpha = alpha
+
+    def estimate(self, info: VideoInfo, height: int = TARGET_HEIGHT) -> float:
+        width = info.width * height / info.height if info.height else height * 16 / 9
+        return self.cpu_per_mpx_second * width * height * info.duration / 1e6
+
+    def update(self, info: VideoInfo, height: int, cpu_seconds: float) -> None:
+        estimate = self.estimate(info, height)
+        if estimate > 0:
+            sample = self.cpu_per_mpx_second * cpu_seconds / estimate
+            self.cpu_per_mpx_second += self._alpha * (sample - self.cpu_per_mpx_second)
+
+
+encode_cost = EncodeCost()
+
+
+# printed by ffmpeg on exit with `-benchmark`, its own rusage whatever else runs alongside
+BENCHMARK_PATTERN = re.compile(rb'bench: utime=([\d.]+)s stime=([\d.]+)s')
+
+
+def ffmpeg_cpu_seconds(stderr: bytes) -> float:
+    match = BENCHMARK_PATTERN.search(stderr)
+    return float(match[1]) + float(match[2]) if match else 0.0
+
+
+async def run_ffmpeg(
+    inputs: list[str],
+    output_path: Path,
+    args: list[str],
+    threads: int | None = None,
+    stdin: int | None = None,
+) -> float:
+    """Run ffmpeg and return the cpu seconds it took.
+
+    `inputs` are the input options, `-i` included. `threads` caps the threads of the encoder and
+    `stdin` is a file descriptor to read `pipe:0` from.
+    """
+    # write to a temporary name so an interrupted encode never leaves a truncated output behind
+    part_path = output_path.with_stem(f'{output_path.stem}.part')
     proc = await asyncio.create_subprocess_exec(
         'ffmpeg',
         '-y',
-        '-i',
-        str(input_path),
-        '-c:v',
-        'libx264',
-        '-vf',
-        f'scale=-2:{TARGET_HEIGHT}',
-        '-b:v',
-        f'{video_kbps}k',
-        '-maxrate',
-        f'{int(video_kbps * 1.2)}k',
-        '-bufsize',
-        f'{video_kbps * 2}k',
-        '-preset',
-        'fast',
-        '-c:a',
-        'aac',
-        '-b:a',
-        f'{AUDIO_KBPS}k',
-        '-movflags',
-        '+faststart',
-        str(output_path),
+        '-benchmark',
+        *inputs,
+        *args,
+        *(['-threads', str(threads)] if threads else []),
+        str(part_path),
+        stdin=stdin if stdin is not None else asyncio.subprocess.DEVNULL,
         stdout=asyncio.subprocess.DEVNULL,
         stderr=asyncio.subprocess.PIPE,
     )
-    _, stderr = await proc.communicate()
+    try:
+        _, stderr = await proc.communicate()
+    except BaseException:
+        # cancelled, ffmpeg would otherwise keep encoding for nobody
+        proc.kill()
+        await proc.wait()
+        part_path.unlink(missing_ok=True)
+        raise
     if proc.returncode != 0:
+        part_path.unlink(missing_ok=True)
         raise RuntimeError(f'ffmpeg failed: {stderr.decode()}')
+    part_path.replace(output_path)
+    return ffmpeg_cpu_seconds(stderr)
+
+
+async def execute(
+    plan: TranscodePlan,
+    info: VideoInfo,
+    name: str,
+    inputs: list[str],
+    output_path: Path,
+    max_bytes: int,
+    threads: int | None = None,
+    stdin: int | None = None,
+    audio_input: int = 0,
+) -> Path:
+    """Run `plan` through ffmpeg, log what it cost and check the result fits."""
+    baseline = encode_cost.estimate(info)
+    start = time.perf_counter()
+    with stage_seconds.time(stage='ffmpeg', handler=''):
+        cpu_seconds = await run_ffmpeg(inputs, output_path, plan.ffmpeg_args(audio_input), threads, stdin)
+    elapsed = time.perf_counter() - start
+    transcode_cpu_seconds.inc(cpu_seconds, action=str(plan.action))
+    if plan.action == Action.ENCODE:
+        assert plan.height is not None
+        encode_cost.update(info, plan.height, cpu_seconds)
+
+    size = output_path.stat().st_size
+    size_mb = size / (1024 * 1024)
+    logger.info(
+        f'{plan.action} of {name} took {elapsed:.1f}s and {cpu_seconds:.1f}s of cpu, '
+        f'saved ~{baseline - cpu_seconds:.1f}s over a full re-encode, {size_mb:.2f}mb'
+    )
+    if size <= max_bytes:
+        return output_path
+    # never leave it behind, it would be taken for a finished transcode and sent
+    await asyncio.to_thread(output_path.unlink)
+    # the estimate of a stream copy was off, a piped input cannot be read again though
+    fallback = plan_encode(info, max_bytes)
+    if plan.action in {Action.REMUX, Action.AUDIO} and fallback.action == Action.ENCODE and stdin is None:
+        logger.info(f'{plan.action} of {name} weighs {size_mb:.2f}mb, falling back to {fallback}')
+        return await execute(fallback, info, name, inputs, output_path, max_bytes, threads, stdin, audio_input)
+    raise TooLargeError(f'{plan.action} of {name} still weighs {size_mb:.2f}mb')
+
+
+async def shrink(
+    input_path: Path,
+    output_path: Path,
+    max_bytes: int = MAX_VIDEO_SIZE_MB * 1024 * 1024,
+    threads: int | None = None,
+) -> Path:
+    """Make a video telegram can take and play, doing as little work as possible.
+
+    Returns the path to send, which is `input_path` itself when nothing had to be done.
+    """
+    info = await probe(input_path)
+    plan = plan_transcode(info, max_bytes)
+    logger.debug(f'transcode plan for {input_path.name}: {plan}')
+
+    if plan.action == Action.REJECT:
+        raise TooLargeError(f'video too long: {plan.reason}')
+    if plan.action == Action.NONE:
+        baseline = encode_cost.estimate(info)
+        logger.info(f'sending {input_path.name} as is, saved ~{baseline:.1f}s of cpu over a full re-encode')
+        return input_path
+
+    return await execute(plan, info, input_path.name, ['-i', str(input_path)], output_path, max_bytes, threads)
+
+
+async def stream_transcode(
+    plan: TranscodePlan,
+    info: VideoInfo,
+    urls: list[tuple[str, dict[str, str]]],
+    output_path: Path,
+    max_bytes: int = MAX_VIDEO_SIZE_MB * 1024 * 1024,
+    threads: int | None = None,
+) -> Path:
+    """Transcode straight from the remote streams, ffmpeg downloads them itself.
+
+    `urls` are (url, http headers) pairs, the video stream first and the audio stream last.
+    """
+    inputs = []
+    for url, headers in urls:
+        inputs += ['-headers', ''.join(f'{k}: {v}\r\n' for k, v in headers.items()), '-i', url]
+    return await execute(
+        plan, info, output_path.name, inputs, output_path, max_bytes, threads, audio_input=len(urls) - 1
+    )
+
 
-    size_mb = output_path.stat().st_size / (1024 * 1024)
-    logger.debug(f'shrunk video saved to {output_path}: {size_mb:.2f}mb')
+async def pipe_transcode(
+    plan: TranscodePlan,
+    info: VideoInfo,
+    cmd: list[str],
+    output_path: Path,
+    max_bytes: int = MAX_VIDEO_SIZE_MB * 1024 * 1024,
+    threads: int | None = None,
+) -> Path:
+    """Transcode what `cmd` writes to its stdout, ffmpeg reads it from a pipe as it is produced."""
+    read_fd, write_fd = os.pipe()
+    try:
+        producer = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=write_fd,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    finally:
+        os.close(write_fd)  # ffmpeg sees the end of the input once the producer exits
+    # drained as it goes, a full stderr pipe would stall the producer
+    drain = asyncio.create_task(producer.communicate())
+    try:
+        inputs = ['-i', 'pipe:0']
+        result = await execute(plan, info, output_path.name, inputs, output_path, max_bytes, threads, read_fd)
+        _, stderr = await drain
+    finally:
+        os.close(read_fd)
+        # ffmpeg failed or we were cancelled, the producer would keep writing to a pipe nobody reads
+        if producer.returncode is None:
+            producer.kill()
+        drain.cancel()
+        await asyncio.gather(drain, return_exceptions=True)
+        await producer.wait()
+    if producer.returncode != 0:
+        # ffmpeg may have muxed a truncated input without complaining
+        await asyncio.to_thread(output_path.unlink, missing_ok=True)
+        raise RuntimeError(f'{cmd[0]} failed: {stderr.decode()}')
+    return result
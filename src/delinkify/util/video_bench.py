@@ -0,0 +1,139 @@
+"""Benchmark the transcode planner against always re-encoding oversized videos.
+
+Builds a corpus of small synthetic videos with ffmpeg (one per kind of input the planner tells
+apart), shrinks every one of them under a 1mb limit and reports the cpu time spent compared to
+the previous behaviour: send files that fit as is, re-encode everything else at 480p.
+
+Run with `python -m delinkify.util.video_bench`.
+"""
+
+import asyncio
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from delinkify.util.video import (
+    AUDIO_KBPS,
+    MAX_VIDEO_KBPS,
+    MIN_VIDEO_KBPS,
+    TARGET_HEIGHT,
+    Action,
+    TranscodePlan,
+    plan_transcode,
+    probe,
+    run_ffmpeg,
+)
+
+MAX_BYTES = 1024 * 1024
+
+VIDEO = ['-f', 'lavfi', '-i', 'testsrc2=size={size}:rate=25:duration={duration}']
+AUDIO = ['-f', 'lavfi', '-i', 'anoisesrc=duration={duration}:amplitude=0.2']
+H264 = ['-c:v', 'libx264', '-preset', 'veryfast', '-b:v', '{kbps}k']
+AAC = ['-c:a', 'aac', '-b:a', '{audio_kbps}k']
+
+# name: (ffmpeg arguments, template values, extension)
+CORPUS: dict[str, tuple[list[str], dict, str]] = {
+    'h264-aac-faststart': (
+        [*VIDEO, *AUDIO, *H264, *AAC, '-movflags', '+faststart'],
+        {'size': '640x360', 'duration': 8, 'kbps': 400, 'audio_kbps': 64},
+        'mp4',
+    ),
+    'h264-aac-moov-at-end': (
+        [*VIDEO, *AUDIO, *H264, *AAC],
+        {'size': '640x360', 'duration': 8, 'kbps': 400, 'audio_kbps': 64},
+        'mp4',
+    ),
+    'h264-loud-audio': (
+        [*VIDEO, *AUDIO, *H264, *AAC],
+        {'size': '640x360', 'duration': 24, 'kbps': 150, 'audio_kbps': 320},
+        'mp4',
+    ),
+    'h264-extra-audio-track': (
+        [*VIDEO, *AUDIO, *AUDIO, '-map', '0:v', '-map', '1:a', '-map', '2:a', *H264, *AAC],
+        {'size': '640x360', 'duration': 16, 'kbps': 300, 'audio_kbps': 192},
+        'mp4',
+    ),
+    'h264-720p-heavy': (
+        [*VIDEO, *AUDIO, *H264, *AAC],
+        {'size': '1280x720', 'duration': 8, 'kbps': 3000, 'audio_kbps': 128},
+        'mp4',
+    ),
+    'vp9-opus-webm': (
+        [*VIDEO, *AUDIO, '-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-b:v', '{kbps}k', '-c:a', 'libopus'],
+        {'size': '854x480', 'duration': 8, 'kbps': 1500},
+        'webm',
+    ),
+    'too-long': (
+        [*VIDEO, *AUDIO, *H264, *AAC],
+        {'size': '320x180', 'duration': 40, 'kbps': 300, 'audio_kbps': 64},
+        'mp4',
+    ),
+}
+
+
+def build_corpus(path: Path) -> list[Path]:
+    files = []
+    for name, (args, values, extension) in CORPUS.items():
+        output = path / f'{name}.{extension}'
+        cmd = ['ffmpeg', '-y', '-v', 'error', *(a.format(**values) for a in args), '-shortest', str(output)]
+        subprocess.run(cmd, check=True)
+        files.append(output)
+    return files
+
+
+async def legacy(input_path: Path, output_path: Path) -> float | None:
+    """Cpu seconds the previous `shrink` spent: nothing if it fit, else a full 480p re-encode. None if it gave up."""
+    info = await probe(input_path)
+    if info.size <= MAX_BYTES:
+        return 0
+    video_kbps = int(min(MAX_BYTES * 8 / 1000 / info.duration - AUDIO_KBPS, MAX_VIDEO_KBPS))
+    if video_kbps < MIN_VIDEO_KBPS:
+        return None
+    plan = TranscodePlan(Action.ENCODE, 'legacy', TARGET_HEIGHT, video_kbps)
+    return await run_ffmpeg(['-i', str(input_path)], output_path, plan.ffmpeg_args())
+
+
+async def planned(input_path: Path, output_path: Path) -> tuple[TranscodePlan, float, float]:
+    """Carry out the plan `shrink` picks, return it with the wall and ffmpeg cpu seconds it took."""
+    plan = plan_transcode(await probe(input_path), MAX_BYTES)
+    start = time.perf_counter()
+    cpu = 0.0
+    if plan.action not in {Action.NONE, Action.REJECT}:
+        cpu = await run_ffmpeg(['-i', str(input_path)], output_path, plan.ffmpeg_args())
+    return plan, time.perf_counter() - start, cpu
+
+
+async def run(corpus: list[Path], out: Path) -> None:
+    logger.info(f'{"video":<26} {"size":>8} {"plan":<8} {"legacy cpu":>10} {"cpu":>8} {"wall":>8}')
+    totals = [0.0, 0.0]
+    for f in corpus:
+        legacy_cpu = await legacy(f, out / f'{f.stem}-legacy.mp4')
+        plan, wall, cpu = await planned(f, out / f'{f.stem}-shrunk.mp4')
+        totals[0] += legacy_cpu or 0
+        totals[1] += cpu
+        size = f.stat().st_size / (1024 * 1024)
+        legacy_str = 'rejected' if legacy_cpu is None else f'{legacy_cpu:.2f}s'
+        logger.info(f'{f.name:<26} {size:>6.2f}mb {plan.action:<8} {legacy_str:>10} {cpu:>7.2f}s {wall:>7.2f}s')
+        logger.debug(f'  {plan}')
+    logger.info(f'{"total":<26} {"":>8} {"":<8} {totals[0]:>9.2f}s {totals[1]:>7.2f}s')
+
+
+def main() -> None:
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', format='{message}')
+    with tempfile.TemporaryDirectory(prefix='delinkify-bench-') as tmp:
+        corpus_path, out_path = Path(tmp, 'corpus'), Path(tmp, 'out')
+        corpus_path.mkdir()
+        out_path.mkdir()
+        logger.info(f'building corpus of {len(CORPUS)} videos...')
+        corpus = build_corpus(corpus_path)
+        logger.disable('delinkify')
+        asyncio.run(run(corpus, out_path))
+
+
+if __name__ == '__main__':
+    main()
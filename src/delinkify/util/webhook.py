@@ -0,0 +1,40 @@
+import asyncio
+import json
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from telegram import Update
+
+if TYPE_CHECKING:
+    from delinkify.context import DelinkifyContext
+
+
+class Webhook:
+    """Counts the updates received through the webhook, before any handler runs.
+
+    When `record_path` is set every update is appended to it, one per line, to replay them later
+    with `python -m delinkify.util.webhook_bench`. Lines are written off the event loop.
+    """
+
+    def __init__(self, record_path: Path | None = None):
+        self.received = 0
+        self._record = record_path.open('a') if record_path else None
+        self._lock = threading.Lock()
+
+    async def observe(self, update: Update, context: DelinkifyContext) -> None:
+        self.received += 1
+        if self._record is not None:
+            await asyncio.to_thread(self._write, json.dumps(update.to_dict()))
+
+    def _write(self, line: str) -> None:
+        with self._lock:
+            if self._record is not None:
+                self._record.write(line + '\n')
+                self._record.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._record is not None:
+                self._record.close()
+                self._record = None
@@ -0,0 +1,146 @@
+"""Measure webhook throughput by replaying updates against python-telegram-bot's webhook server, offline.
+
+Updates come from a file recorded with DELINKIFY_WEBHOOK_RECORD_PATH (one update per line)
+or are synthesized as inline queries. They are posted over a few keep-alive connections, like
+Telegram does, to an `Updater` whose queue is drained by workers that simulate handler latency
+with the given update concurrency. Nothing reaches Telegram.
+
+Run with `python -m delinkify.util.webhook_bench [recorded.jsonl]`.
+"""
+
+import asyncio
+import json
+import socket
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from loguru import logger
+from telegram import Bot, User
+from telegram.ext import Updater
+
+UPDATES = 1000
+CONNECTIONS = 40  # telegram's default max_connections
+HANDLER_SECONDS = 0.01  # simulated time spent answering an update
+CONCURRENCY = [1, 4, 16, 64]
+WEBHOOK_KEY = 'bench'  # secret token the replayed requests carry
+PATH = '/webhook'
+
+
+class OfflineBot(Bot):
+    """Answers the calls the updater makes on start without asking Telegram."""
+
+    async def get_me(self, *args, **kwargs) -> User:
+        self._bot_user = User(1, 'bench', is_bot=True, username='bench_bot')
+        return self._bot_user
+
+    async def set_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def synthetic_updates(count: int) -> list[bytes]:
+    user = {'id': 1, 'is_bot': False, 'first_name': 'bench'}
+    return [
+        json.dumps({
+            'update_id': i,
+            'inline_query': {
+                'id': str(i),
+                'from': user,
+                'query': f'https://x.com/user/status/{i}',
+                'offset': '',
+            },
+        }).encode()
+        for i in range(count)
+    ]
+
+
+async def post_all(port: int, bodies: list[bytes], sent_at: dict[int, float]) -> None:
+    async def connection(chunk: list[tuple[int, bytes]]) -> None:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for i, body in chunk:
+            head = (
+                f'POST {PATH} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                f'X-Telegram-Bot-Api-Secret-Token: {WEBHOOK_KEY}\r\nContent-Length: {len(body)}\r\n\r\n'
+            )
+            sent_at[i] = time.perf_counter()
+            writer.write(head.encode() + body)
+            await writer.drain()
+            await reader.readuntil(b'\r\n\r\n')  # responses have no body
+        writer.close()
+        await writer.wait_closed()
+
+    indexed = list(enumerate(bodies))
+    await asyncio.gather(*(connection(indexed[c::CONNECTIONS]) for c in range(CONNECTIONS)))
+
+
+async def run(bodies: list[bytes], concurrency: int) -> tuple[float, list[float]]:
+    """Replay `bodies`, returning the seconds taken and the latency of every update."""
+    queue: asyncio.Queue = asyncio.Queue()
+    updater = Updater(OfflineBot('1:bench'), queue)
+    port = free_port()
+    await updater.initialize()
+    await updater.start_webhook(
+        listen='127.0.0.1',
+        port=port,
+        url_path=PATH,
+        webhook_url=f'http://127.0.0.1:{port}{PATH}',
+        secret_token=WEBHOOK_KEY,
+    )
+
+    sent_at: dict[int, float] = {}
+    latencies: list[float] = []
+
+    async def process() -> None:
+        while True:
+            update = await queue.get()
+            await asyncio.sleep(HANDLER_SECONDS)
+            latencies.append(time.perf_counter() - sent_at[int(update.inline_query.id)])
+            queue.task_done()
+
+    workers = [asyncio.create_task(process()) for _ in range(concurrency)]
+    start = time.perf_counter()
+    await post_all(port, bodies, sent_at)
+    await queue.join()
+    elapsed = time.perf_counter() - start
+    for w in workers:
+        w.cancel()
+    await updater.stop()
+    await updater.shutdown()
+    return elapsed, latencies
+
+
+def main() -> None:
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', format='{message}')
+    if len(sys.argv) > 1:
+        lines = Path(sys.argv[1]).read_bytes().splitlines()
+        # inline query ids are reused to match updates to their post, renumber them
+        bodies = []
+        for i, line in enumerate(filter(None, lines)):
+            data = json.loads(line)
+            if 'inline_query' in data:
+                data['inline_query']['id'] = str(i)
+                bodies.append(json.dumps(data).encode())
+        logger.info(f'replaying {len(bodies)} recorded inline queries')
+    else:
+        bodies = synthetic_updates(UPDATES)
+        logger.info(f'replaying {len(bodies)} synthetic inline queries')
+
+    logger.disable('delinkify')
+    logger.info(f'{"concurrency":>11} {"updates/s":>10} {"p50":>8} {"p99":>8}')
+    for concurrency in CONCURRENCY:
+        elapsed, latencies = asyncio.run(run(bodies, concurrency))
+        quantiles = statistics.quantiles(latencies, n=100)
+        p50, p99 = quantiles[49] * 1000, quantiles[98] * 1000
+        logger.info(f'{concurrency:>11} {len(bodies) / elapsed:>10.0f} {p50:>6.0f}ms {p99:>6.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
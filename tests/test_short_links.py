@@ -0,0 +1,155 @@
+import asyncio
+from collections.abc import Callable
+
+import httpx
+import pytest
+
+from delinkify.util import short_links
+from delinkify.util.short_links import MAX_REDIRECTS, ShortLinkResolver
+
+# (method) -> (status, headers, seconds to wait before answering)
+type Route = Callable[[str], tuple[int, dict[str, str], float]]
+
+
+def redirect(location: str, status: int = 301) -> Route:
+    return lambda method: (status, {'Location': location}, 0)
+
+
+def answer(status: int, delay: float = 0) -> Route:
+    return lambda method: (status, {}, delay)
+
+
+class StubServer:
+    """Answers the requests for each `https://host/path` with its route, recording them as (method, url)."""
+
+    def __init__(self, routes: dict[str, Route]):
+        self.routes = routes
+        self.requests: list[tuple[str, str]] = []
+
+    async def __aenter__(self) -> StubServer:
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        self._server.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while request_line := await reader.readline():
+            method, target, _ = request_line.decode().split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in {b'\r\n', b''}:
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+            url = f'https://{headers["host"]}{target}'
+            self.requests.append((method, url))
+            status, extra, delay = self.routes.get(url, answer(404))(method)
+            await asyncio.sleep(delay)
+            fields = ''.join(f'{k}: {v}\r\n' for k, v in {'Content-Length': '0', **extra}.items())
+            writer.write(f'HTTP/1.1 {status} Stub\r\n{fields}\r\n'.encode())
+            await writer.drain()
+        writer.close()
+
+    def resolver(self, ttl: int = 60) -> ShortLinkResolver:
+        return ShortLinkResolver(ttl, transport=LocalTransport(self.port))
+
+
+class LocalTransport(httpx.AsyncBaseTransport):
+    """Sends every request to the stub server, in plain http. The Host header keeps the original host."""
+
+    def __init__(self, port: int):
+        self._port = port
+        self._transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.url = request.url.copy_with(scheme='http', host='127.0.0.1', port=self._port)
+        return await self._transport.handle_async_request(request)
+
+
+async def resolve_all(routes: dict[str, Route], *urls: str, ttl: int = 60) -> tuple[list[str], StubServer]:
+    async with StubServer(routes) as server:
+        resolver = server.resolver(ttl)
+        try:
+            return [await resolver.resolve(url) for url in urls], server
+        finally:
+            await resolver.close()
+
+
+def test_follows_a_redirect_chain():
+    routes = {
+        'https://vm.tiktok.com/abc': redirect('https://vt.tiktok.com/def'),
+        'https://vt.tiktok.com/def': redirect('https://www.tiktok.com/@user/video/1?is_from_webapp=1', 302),
+    }
+    targets, server = asyncio.run(resolve_all(routes, 'https://vm.tiktok.com/abc'))
+    assert targets == ['https://tiktok.com/@user/video/1']
+    assert server.requests == [('HEAD', 'https://vm.tiktok.com/abc'), ('HEAD', 'https://vt.tiktok.com/def')]
+
+
+def test_falls_back_to_get_when_head_is_not_allowed():
+    def head_not_allowed(method: str) -> tuple[int, dict[str, str], float]:
+        return (405, {}, 0) if method == 'HEAD' else (301, {'Location': 'https://www.reddit.com/comments/abc/'}, 0)
+
+    routes = {'https://redd.it/abc': head_not_allowed}
+    targets, server = asyncio.run(resolve_all(routes, 'https://redd.it/abc'))
+    assert targets == ['https://reddit.com/comments/abc']
+    assert server.requests == [('HEAD', 'https://redd.it/abc'), ('GET', 'https://redd.it/abc')]
+
+
+def test_leaves_links_that_are_not_short_alone():
+    targets, server = asyncio.run(resolve_all({}, 'https://tiktok.com/@user/video/1'))
+    assert targets == ['https://tiktok.com/@user/video/1']
+    assert server.requests == []
+
+
+def test_stops_after_max_redirects():
+    routes = {f'https://t.co/{i}': redirect(f'https://t.co/{i + 1}') for i in range(MAX_REDIRECTS * 2)}
+    targets, server = asyncio.run(resolve_all(routes, 'https://t.co/0'))
+    assert targets == [f'https://t.co/{MAX_REDIRECTS}']
+    assert len(server.requests) == MAX_REDIRECTS
+
+
+def test_remembers_resolved_links_until_they_expire():
+    routes = {'https://youtu.be/abc': redirect('https://youtube.com/watch?v=abc')}
+    targets, server = asyncio.run(resolve_all(routes, 'https://youtu.be/abc', 'https://youtu.be/abc'))
+    assert targets == ['https://youtube.com/watch?v=abc'] * 2
+    assert len(server.requests) == 1
+
+    targets, server = asyncio.run(resolve_all(routes, 'https://youtu.be/abc', 'https://youtu.be/abc', ttl=0))
+    assert targets == ['https://youtube.com/watch?v=abc'] * 2
+    assert len(server.requests) == 2
+
+
+def test_evicts_the_least_recently_used_links(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(short_links, 'MAX_ENTRIES', 2)
+    routes = {f'https://dai.ly/{i}': redirect(f'https://dailymotion.com/video/{i}') for i in 'abc'}
+
+    async def main() -> tuple[list[str], int]:
+        async with StubServer(routes) as server:
+            resolver = server.resolver()
+            for i in 'abac':
+                await resolver.resolve(f'https://dai.ly/{i}')
+            await resolver.close()
+            return list(resolver._entries), resolver.hits
+
+    entries, hits = asyncio.run(main())
+    assert entries == ['https://dai.ly/a', 'https://dai.ly/c']
+    assert hits == 1
+
+
+def test_returns_the_link_itself_when_it_cannot_be_followed(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(short_links, 'TIMEOUT', 0.2)
+    routes = {'https://t.co/slow': answer(301, delay=1), 'https://t.co/broken': answer(500)}
+    targets, server = asyncio.run(resolve_all(routes, 'https://t.co/slow', 'https://t.co/broken'))
+    assert targets == ['https://t.co/slow', 'https://t.co/broken']
+    assert len(server.requests) == 2
+
+
+def test_remembers_failures_briefly(monkeypatch: pytest.MonkeyPatch):
+    routes = {'https://t.co/broken': answer(500)}
+    targets, server = asyncio.run(resolve_all(routes, 'https://t.co/broken', 'https://t.co/broken'))
+    assert targets == ['https://t.co/broken'] * 2
+    assert len(server.requests) == 1
+
+    monkeypatch.setattr(short_links, 'FAILURE_TTL', 0)
+    targets, server = asyncio.run(resolve_all(routes, 'https://t.co/broken', 'https://t.co/broken'))
+    assert len(server.requests) == 2